@@ -1,16 +1,33 @@
+import os
 import sys
 import click
-from configparser import ConfigParser
+from configparser import ConfigParser, Error as ConfigError
+from contextlib import nullcontext
 from functools import wraps
 from time import time
+from datetime import date
 from tqdm import tqdm
-from progress.bar import ChargingBar
 
-from .patient_generator import generate_patient, generator_set_up
+from numpy.random import SeedSequence
 
-from .helpers_csv import append_to_csv
+from .patient_generator import ENGINES, generator_set_up, create_writers, worker_set_up, generate_chunk, \
+    generate_batch_chunk, aggregate_chunk, chunk_counts, parse_bands, find_bundle, compile_bundle, \
+    reference_digest, output_files
+from .benchmark import bench
 
-from concurrent.futures import ProcessPoolExecutor, as_completed
+from .helpers_arrow import FORMATS
+from .helpers_executor import BACKENDS, create_executor, run_in_order
+from .helpers_profile import Profiler
+from .helpers_trace import write_trace
+from .helpers_aggregate import STRATA, strata_vocabularies, merge_counts, prevalence_rows
+from .helpers_csv import COMPRESSIONS, create_csv, append_to_csv
+from .helpers_writer import BackgroundWriter
+from .helpers_sqlite import parse_output
+from .helpers_shard import parse_shard, shard_chunks, shard_directory, file_digest, write_manifest, merge_shards
+from .helpers_journal import JOURNAL, Journal, read_journal, commit_file
+from .helpers_id import id_space_size
+
+from concurrent.futures import wait, FIRST_COMPLETED
 
 # read the configuration file
 parser = ConfigParser()
@@ -18,6 +35,36 @@ parser.read('config.ini')
 
 # population to produce
 population_size = int(parser.get('generate', 'population_size'))
+# rows to collect before writing them to CSV
+buffer_size = parser.getint('generate', 'buffer_size', fallback=10000)
+# patients generated by a single task
+chunk_size = parser.getint('generate', 'chunk_size', fallback=10000)
+# tasks submitted but not yet written out
+max_pending = parser.getint('generate', 'max_pending', fallback=10)
+# number of workers, by default one per CPU
+workers = parser.getint('generate', 'workers', fallback=os.cpu_count())
+# how tasks are executed
+backend = parser.get('generate', 'backend', fallback='process')
+# how patients are generated
+engine = parser.get('generate', 'engine', fallback='scalar')
+# seed for reproducible runs, fresh entropy by default
+seed = parser.getint('generate', 'seed', fallback=None)
+# format of the output files
+output_format = parser.get('generate', 'format', fallback='csv')
+# database to write to instead of files
+output = parser.get('generate', 'output', fallback=None)
+# date ages are calculated at, the current date by default
+reference_date = parser.get('generate', 'reference_date', fallback=None)
+# age ranges to save timeline records for
+timeline_bands = parser.get('generate', 'timeline_bands', fallback='all')
+# static profiles each worker keeps posterior probabilities for
+cache_size = parser.getint('generate', 'cache_size', fallback=1024)
+# compression of the output files
+compression = parser.get('generate', 'compression', fallback='none')
+# chunks waiting to be written by the background writer
+write_queue = parser.getint('generate', 'write_queue', fallback=4)
+# whether to flush every chunk to disk and record it, so an interrupted run can be resumed
+checkpoint = parser.getboolean('generate', 'checkpoint', fallback=False)
 
 def timing(f):
     """
@@ -31,39 +78,339 @@ def timing(f):
         return result
     return wrapper
 
-@click.command()
-@click.option('--prob', is_flag=True, help="Display probability details")
+@click.group(invoke_without_command=True)
+@click.option('--prob', is_flag=True, help="Record probability details for every patient, as --trace-sample 1")
 @click.option('--display', is_flag=True, help="Display patient details while populating")
 @click.option('--population', '-p', default=population_size, \
                 help='How many patients to produce')
+@click.option('--buffer', default=buffer_size, \
+                help='How many rows to collect before writing them to CSV')
+@click.option('--chunk-size', default=chunk_size, type=click.IntRange(min=1), \
+                help='How many patients to generate in a single task')
+@click.option('--max-pending', default=max_pending, type=click.IntRange(min=1), \
+                help='How many tasks to have submitted at any one time')
+@click.option('--workers', '-w', default=workers, type=click.IntRange(min=1), \
+                help='How many worker processes or threads to use')
+@click.option('--backend', default=backend, type=click.Choice(BACKENDS), \
+                help='Run tasks serially, in worker processes or in threads')
+@click.option('--engine', default=engine, type=click.Choice(ENGINES), \
+                help='Generate patients one at a time, or vectorised over each chunk')
+@click.option('--seed', default=seed, type=int, \
+                help='Seed to reproduce a run with, together with the same chunk size')
+@click.option('--format', 'output_format', default=output_format, type=click.Choice(FORMATS), \
+                help='Write output as CSV, Parquet or Arrow files')
+@click.option('--output', default=output, \
+                help='Write patients and timelines to a SQLite database instead of files, as sqlite:path.db')
+@click.option('--reference-date', default=reference_date, type=click.DateTime(['%Y-%m-%d']), \
+                help='Date ages are calculated at, as YYYY-MM-DD, the current date by default')
+@click.option('--profile', is_flag=True, help="Display time spent in each stage and module")
+@click.option('--profile-output', type=click.Path(dir_okay=False), \
+                help='File to save the time spent in each stage and module to, as JSON')
+@click.option('--trace-sample', default=0.0, type=click.FloatRange(0, 1), \
+                help='Fraction of patients to record probability details for')
+@click.option('--trace-id', 'trace_ids', multiple=True, \
+                help='Id of a patient to record probability details for, can be given more than once')
+@click.option('--trace', 'trace_output', default='output/trace.jsonl', type=click.Path(dir_okay=False), \
+                help="File to save probability details to, as JSON lines, kept in the shard's directory with --shard")
+@click.option('--aggregate', is_flag=True, \
+                help='Only save state counts by module, age range, region, ethnicity, gender and deprivation')
+@click.option('--timeline-bands', default=timeline_bands, \
+                help='Age ranges to save timeline records for: all, current or a comma separated list')
+@click.option('--cache-size', default=cache_size, type=click.IntRange(0), \
+                help='How many static profiles each worker keeps posterior probabilities for, 0 to disable')
+@click.option('--shard', help='Only generate shard i of N, as i/N counting from 0, into its own directory')
+@click.option('--checkpoint/--no-checkpoint', default=checkpoint, \
+                help='Flush every chunk of CSV output to disk and record it, so the run can be resumed')
+@click.option('--resume', is_flag=True, help='Continue an interrupted run from its last committed chunk')
+@click.option('--compression', default=compression, type=click.Choice(list(COMPRESSIONS)), \
+                help='Compress the output files with gzip or zstd')
+@click.option('--write-queue', default=write_queue, type=click.IntRange(0), \
+                help='How many chunks to queue for the background writer, 0 to write in the main thread')
+@click.pass_context
+def main(ctx, population, display, prob, buffer, chunk_size, max_pending, workers, backend, engine, seed, output_format, \
+         output, reference_date, profile, profile_output, trace_sample, trace_ids, trace_output, aggregate, timeline_bands, \
+         cache_size, shard, checkpoint, resume, compression, write_queue):
+    """The main routine, generating patients unless a command is given."""
+    if ctx.invoked_subcommand is None and aggregate and (shard or resume or output):
+        raise click.UsageError('--shard, --resume and --output cannot be used with --aggregate')
+    elif ctx.invoked_subcommand is None and aggregate:
+        aggregate_prevalence(population=population, chunk_size=chunk_size, max_pending=max_pending, \
+                             workers=workers, backend=backend, seed=seed, reference_date=reference_date)
+    elif ctx.invoked_subcommand is None:
+        generate(population=population, display=display, trace_sample=1.0 if prob else trace_sample, \
+                 trace_ids=trace_ids, trace_output=trace_output, buffer=buffer, chunk_size=chunk_size, \
+                 max_pending=max_pending, workers=workers, backend=backend, engine=engine, seed=seed, \
+                 output_format=output_format, output=output, reference_date=reference_date, \
+                 profile=profile or bool(profile_output), profile_output=profile_output, \
+                 timeline_bands=timeline_bands, cache_size=cache_size, shard=shard, checkpoint=checkpoint, \
+                 resume=resume, compression=compression, write_queue=write_queue)
+
+main.add_command(bench)
+
+@main.command('compile')
+def compile_reference():
+    """Validate the config and input files and compile them into a bundle."""
+    try:
+        location, digest = compile_bundle()
+    except (ConfigError, OSError, ValueError) as e:
+        raise click.ClickException(str(e))
+    print(f"Compiled reference data {digest[:16]} to {location}")
+    print("Runs with the same config and input files will load it instead of the input files.")
+
+@main.command('merge')
+@click.argument('shards', nargs=-1, type=click.Path(file_okay=False, exists=True))
+@click.option('--output', '-o', default='output', type=click.Path(file_okay=False), \
+                help='Directory to write the merged files to')
+def merge(shards, output):
+    """Validate the manifests of a sharded run and concatenate its shards."""
+    try:
+        manifest = merge_shards(shards, output)
+    except (OSError, KeyError, ValueError) as e:
+        raise click.ClickException(str(e))
+    print(f"Merged {manifest['shards']} shards into {output}: " \
+          f"{manifest['rows']['patients']:,} patients, {manifest['rows']['timelines']:,} timeline rows")
+
 @timing
-def main(population, display, prob):
-    """The main routine."""
+def generate(*, population, display, trace_sample, trace_ids, trace_output, buffer, chunk_size, max_pending, \
+             workers, backend, engine='scalar', seed, output_format, output=None, reference_date, profile=False, \
+             profile_output=None, timeline_bands='all', cache_size=1024, shard=None, checkpoint=False, resume=False, \
+             compression='none', write_queue=4):
+    """
+    Generate patients and timelines and save them to the output files
+    Parameters:
+        the options of main, by keyword only, so that options can never be passed in the wrong order
+    Returns:
+        None
+    """
+    # the vectorised generators do not record probability details
+    if engine == 'batch' and (trace_sample > 0 or trace_ids):
+        raise click.UsageError('--prob, --trace-sample and --trace-id need --engine scalar')
+    chunks = list(enumerate(chunk_counts(population, chunk_size)))
+    output_dir = 'output'
+    database = None
+    if output:
+        try:
+            database = parse_output(output)
+        except ValueError as e:
+            raise click.BadParameter(str(e), param_hint='--output')
+        if shard or compression != 'none':
+            raise click.UsageError('--output cannot be used with --shard or --compression')
+    if shard:
+        try:
+            shard_index, shards = parse_shard(shard)
+        except ValueError as e:
+            raise click.BadParameter(str(e), param_hint='--shard')
+        # every shard must draw from the same run, so shards need a seed
+        if seed is None:
+            raise click.UsageError('--shard needs a --seed shared by every shard')
+        chunks = shard_chunks([count for _, count in chunks], shard_index, shards)
+        chunk_range = [chunks[0][0], chunks[-1][0] + 1] if chunks else []
+        output_dir = shard_directory(shard_index, shards)
+        # concurrent shards must not share a trace file
+        trace_output = os.path.join(output_dir, os.path.basename(trace_output))
+
+    # with checkpoints, completed chunks are flushed to disk and recorded in a journal,
+    # and csv files can be truncated back to the last one
+    checkpoint = checkpoint or resume
+    if checkpoint and (output_format != 'csv' or database is not None):
+        raise click.UsageError('--checkpoint and --resume are only supported for csv output')
+    journal_location = os.path.join(output_dir, JOURNAL)
+    resumed, last = None, None
+    if resume:
+        try:
+            resumed, last, complete = read_journal(journal_location)
+        except (OSError, ValueError) as e:
+            raise click.UsageError(f"Cannot resume: {e}")
+        if complete:
+            print(f"The run in {output_dir} already finished, there is nothing to resume.")
+            return
+        # an interrupted run continues with its own seed
+        seed = resumed['seed'] if seed is None else seed
+
     start_time = time()
-    country, demographics, deprivation, ages, modules = generator_set_up()
-    with ProcessPoolExecutor(max_workers=5) as pool:
-        print(f"Starting generation of {population:,} patients.")
-        # set up lists for generated data
-        patients = []
-        timelines = []
-        futures = []
-        for i in tqdm(range(population)):
-            futures.append(pool.submit(generate_patient, country, demographics, deprivation, ages, modules, display, prob))
+    profiler = Profiler(enabled=profile)
+    tic = profiler.start()
+    # fix the date once, so every patient's age is calculated at the same date
+    if reference_date:
+        reference_date = reference_date.date()
+    elif resumed:
+        reference_date = date.fromisoformat(resumed['reference_date'])
+    else:
+        reference_date = date.today()
+    print(f"Reference date: {reference_date}")
+    bundle = find_bundle()
+    reference = generator_set_up(reference_date, bundle)
+    country, demographic_index, deprivation, ages, modules = reference
+    profiler.stop('set_up', tic)
+    # ids follow patient positions in the whole run, so this also covers every shard
+    ids = id_space_size(country)
+    if population > ids:
+        raise click.BadParameter(f"{population:,} patients need more than the {ids:,} distinct ids of {country}", \
+                                 param_hint='--population')
+    try:
+        bands = parse_bands(timeline_bands, ages)
+    except ValueError as e:
+        raise click.BadParameter(str(e), param_hint='--timeline-bands')
+    initializer, initargs = worker_set_up(backend, reference, bundle, reference_date, \
+                                          (display, trace_sample, trace_ids, profile, bands, cache_size))
+    # every chunk draws from its own stream spawned from the run's seed
+    entropy = SeedSequence(seed).entropy
+    tracing = trace_sample > 0 or len(trace_ids) > 0
+
+    # settings a resumed run must share with the run it continues
+    run = {
+        'population': population,
+        'chunk_size': chunk_size,
+        'engine': engine,
+        'seed': entropy,
+        'format': output_format,
+        'compression': compression,
+        'reference_date': reference_date.isoformat(),
+        'timeline_bands': timeline_bands,
+        'modules': list(modules),
+        'input_hash': reference_digest(),
+        'trace': trace_output if tracing else None,
+    }
+    rows = {'patients': 0, 'timelines': 0}
+    if tracing:
+        rows['trace'] = 0
+    if resumed:
+        for key, value in run.items():
+            if resumed.get(key) != value:
+                raise click.UsageError(f"Cannot resume: {key} was {resumed.get(key)}, now {value}")
+    if last:
+        # drop anything written after the last committed chunk
+        files = dict(output_files(output_format, output_dir, compression), trace=trace_output)
+        for name, offset in last['offsets'].items():
+            os.truncate(files[name], offset)
+        chunks = [(index, count) for index, count in chunks if index > last['chunk']]
+        rows = dict(last['rows'])
+        print(f"Resuming after chunk {last['chunk']}, with {rows['patients']:,} patients already saved.")
+
+    try:
+        patients, timelines = create_writers(output_format, demographic_index, ages, modules, buffer, output_dir, \
+                                             append=bool(last), compression=compression, database=database)
+    except ValueError as e:
+        raise click.BadParameter(str(e), param_hint='--compression')
+    if checkpoint:
+        journal = Journal(journal_location, None if last else run)
+    else:
+        # the files are replaced, so an earlier run's journal no longer describes them
+        if os.path.exists(journal_location):
+            os.remove(journal_location)
+        journal = nullcontext()
+    # trace events are written by the main process only, so they never interleave
+    trace = open(trace_output, 'a' if last else 'w') if tracing else open(os.devnull, 'w')
+    with create_executor(backend, workers, initializer, initargs) as pool, patients, timelines, trace, journal:
+        total = sum(count for _, count in chunks)
+        print(f"Starting generation of {total:,} patients.")
+        bar = tqdm(total=total)
+        print(f"Seed: {entropy}")
+
+        # runs on the writer thread, one chunk at a time in chunk order
+        def write_chunk(index, chunk_patients, chunk_timelines, chunk_stages, chunk_events):
+            profiler.merge(chunk_stages)
+            write_trace(trace, chunk_events)
+            tic = profiler.start()
+            # the batch engine's chunks are columns, serialised without building rows
+            if engine == 'batch':
+                patients.write_columns(chunk_patients)
+                timelines.write_columns(chunk_timelines)
+            else:
+                patients.write(chunk_patients)
+                timelines.write(chunk_timelines)
+            rows['patients'] += len(chunk_patients)
+            rows['timelines'] += len(chunk_timelines)
+            if tracing:
+                rows['trace'] += len(chunk_events)
+            # the chunk is committed once its rows are on disk and journalled
+            if checkpoint:
+                offsets = {'patients': patients.commit(), 'timelines': timelines.commit()}
+                if tracing:
+                    offsets['trace'] = commit_file(trace)
+                journal.commit(index, offsets, rows)
+            profiler.stop('write', tic)
+            bar.update(len(chunk_patients))
+
+        # chunks are written in order, whichever worker finishes first, and only
+        # a bounded number are kept in flight or waiting to be written
+        task = generate_batch_chunk if engine == 'batch' else generate_chunk
+        with BackgroundWriter(write_queue) as writer:
+            run_in_order(pool, task, [(count, entropy, index, index * chunk_size) for index, count in chunks], \
+                         max_pending, lambda position, result: writer.submit(write_chunk, chunks[position][0], *result))
+        bar.close()
+        if checkpoint:
+            journal.complete()
 
         print(f"Generation executed in {(time() - start_time):.3f} seconds.")
 
-        bar = ChargingBar("Saving to CSV", max=population)
-        for x in as_completed(futures):
-            patients.append(x.result()[0])
-            timelines.append(x.result()[1:])
-            bar.next()
-        bar.finish()
+    if shard:
+        # written last, so only finished shards have a manifest
+        write_manifest(output_dir, {
+            'shard': shard_index,
+            'shards': shards,
+            'chunks': chunk_range,
+            **run,
+            'config_hash': file_digest('config.ini'),
+            'files': {'patients': os.path.basename(patients.location), \
+                      'timelines': os.path.basename(timelines.location), \
+                      **({'trace': os.path.basename(trace_output)} if tracing else {})},
+            'rows': rows,
+            'complete': True,
+        })
+        print(f"Shard {shard_index} of {shards} saved to {output_dir}")
+
+    if profile:
+        # worker stages are summed over all workers
+        profiler.summary()
+    if profile_output:
+        profiler.save(profile_output)
+
+@timing
+def aggregate_prevalence(*, population, chunk_size, max_pending, workers, backend, seed, reference_date):
+    """
+    Generate patients and save only the counts of module states by stratum
+    and age range to output/prevalence.csv
+    Parameters:
+        the options of main
+    Returns:
+        None
+    """
+    reference_date = reference_date.date() if reference_date else date.today()
+    print(f"Reference date: {reference_date}")
+    bundle = find_bundle()
+    reference = generator_set_up(reference_date, bundle)
+    country, demographic_index, deprivation, ages, modules = reference
+    initializer, initargs = worker_set_up(backend, reference, bundle, reference_date)
+    with create_executor(backend, workers, initializer, initargs) as pool:
+        print(f"Starting aggregation of {population:,} patients.")
+        bar = tqdm(total=population)
+        entropy = SeedSequence(seed).entropy
+        print(f"Seed: {entropy}")
+
+        # counts are merged as chunks complete, in any order
+        total = None
+        pending = {}
+
+        def collect(done):
+            nonlocal total
+            for future in done:
+                total = merge_counts(total, future.result())
+                bar.update(pending.pop(future))
+
+        for index, count in enumerate(chunk_counts(population, chunk_size)):
+            while len(pending) >= max_pending:
+                collect(wait(pending, return_when=FIRST_COMPLETED).done)
+            pending[pool.submit(aggregate_chunk, count, entropy, index, index * chunk_size)] = count
+        while pending:
+            collect(wait(pending, return_when=FIRST_COMPLETED).done)
+        bar.close()
 
-        # append them to relevant CSVs
-        append_to_csv('output/patients.csv', patients)
-        [append_to_csv('output/timelines.csv', timeline) for timeline in timelines]
+    create_csv('output/prevalence.csv', ','.join(STRATA + ['age_range', 'module', 'state', 'count']))
+    if total is not None:
+        vocabularies = strata_vocabularies(demographic_index, deprivation)
+        append_to_csv('output/prevalence.csv', prevalence_rows(total, vocabularies, ages, modules))
 
-        
 
 if __name__ == "__main__":
     exit(main())
\ No newline at end of file
@@ -0,0 +1,226 @@
+#!/usr/bin/python3
+import json
+import os
+import platform
+import resource
+import sys
+import tempfile
+import click
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import redirect_stdout
+from datetime import date, datetime
+from time import perf_counter
+
+import numpy as np
+
+from .patient_generator import ENGINES, generator_set_up, worker_set_up, create_writers, generate_chunk, \
+    generate_batch_chunk, chunk_counts, find_bundle
+from .helpers_arrow import FORMATS
+from .helpers_csv import COMPRESSIONS
+from .helpers_executor import BACKENDS, create_executor, run_in_order
+from .helpers_profile import Profiler
+from .helpers_writer import BackgroundWriter
+
+# date ages are calculated at, fixed so that benchmark runs are comparable
+REFERENCE_DATE = date(2021, 1, 1)
+
+
+def peak_rss_mb(backend):
+    """
+    Peak resident set size of this process and of its largest finished worker process.
+    Both are high-water marks over the life of the process, so each scenario runs in a fresh one
+    Parameters:
+        backend: one of `serial`, `process` or `thread`
+    Returns:
+        a dictionary of peak RSS in megabytes, workers None unless they are processes
+    """
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    scale = 1 if sys.platform == 'darwin' else 1024
+    return {
+        'main': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale / 2 ** 20,
+        'workers': resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * scale / 2 ** 20 \
+            if backend == 'process' else None,
+    }
+
+
+def run_scenario(reference, bundle, *, population, module_count, workers, backend, engine, output_format, \
+                 compression, seed, chunk_size, max_pending=10, cache_size=1024, stages=True):
+    """
+    Run a single benchmark scenario through the same chunk tasks and writers
+    as a generate run, saving the output to a temporary directory
+    Parameters:
+        reference: a tuple of country, demographic index, deprivation index, ages and modules
+        bundle: location of the compiled bundle the reference data was loaded from, if any
+        population: number of patients to generate
+        module_count: number of modules to run, taken in config order
+        workers: number of worker processes or threads, None for the serial backend
+        backend: one of `serial`, `process` or `thread`
+        engine: one of `scalar` or `batch`
+        output_format: one of `csv`, `parquet` or `arrow`
+        compression: one of `none`, `gzip` or `zstd`
+        seed: the run's seed
+        chunk_size: maximum number of patients in a chunk
+        max_pending: maximum number of chunks submitted or waiting to be written
+        cache_size: number of static profiles to keep in each worker's PosteriorCache
+        stages: boolean, whether to time each stage, as --profile does
+    Returns:
+        a dictionary of results
+    """
+    country, demographic_index, deprivation, ages, modules = reference
+    # modules are taken in config order, as later ones may depend on earlier ones
+    selected = dict(list(modules.items())[:module_count])
+    shared = (country, demographic_index, deprivation, ages, selected)
+    # workers loading the bundle would run all of its modules
+    if len(selected) < len(modules):
+        bundle = None
+    initializer, initargs = worker_set_up(backend, shared, bundle, REFERENCE_DATE, \
+                                          (False, 0.0, (), stages, None, cache_size))
+    task = generate_batch_chunk if engine == 'batch' else generate_chunk
+    chunks = list(enumerate(chunk_counts(population, chunk_size)))
+    profiler = Profiler(enabled=stages)
+    rows = {'patients': 0, 'timelines': 0}
+
+    with tempfile.TemporaryDirectory() as directory:
+        tic = perf_counter()
+        patients, timelines = create_writers(output_format, demographic_index, ages, selected, \
+                                             output_dir=directory, compression=compression)
+
+        # runs on the writer thread, as in generate
+        def write_chunk(chunk_patients, chunk_timelines, chunk_stages, chunk_events):
+            profiler.merge(chunk_stages)
+            tic = profiler.start()
+            # the batch engine's chunks are columns, serialised without building rows
+            if engine == 'batch':
+                patients.write_columns(chunk_patients)
+                timelines.write_columns(chunk_timelines)
+            else:
+                patients.write(chunk_patients)
+                timelines.write(chunk_timelines)
+            rows['patients'] += len(chunk_patients)
+            rows['timelines'] += len(chunk_timelines)
+            profiler.stop('write', tic)
+
+        try:
+            with create_executor(backend, workers, initializer, initargs) as pool, BackgroundWriter() as writer:
+                run_in_order(pool, task, [(count, seed, index, index * chunk_size) for index, count in chunks], \
+                             max_pending, lambda position, result: writer.submit(write_chunk, *result))
+        finally:
+            # the writers write out their last rows as they close, which is part of writing
+            closing = profiler.start()
+            patients.close()
+            timelines.close()
+            profiler.stop('write', closing)
+        wall = perf_counter() - tic
+
+    # stages by module are summed, e.g. every `run_module: <module>`, and counters like cache hits left out
+    stage_seconds = {}
+    for stage, (seconds, calls) in profiler.stages.items():
+        if seconds > 0:
+            name = stage.split(':')[0]
+            stage_seconds[name] = stage_seconds.get(name, 0.0) + seconds
+
+    return {
+        'population': population,
+        'modules': list(selected),
+        'workers': workers,
+        'backend': backend,
+        'engine': engine,
+        'format': output_format,
+        'compression': compression,
+        'seed': seed,
+        'chunk_size': chunk_size,
+        'wall_seconds': wall,
+        'patients_per_sec': population / wall,
+        'timeline_rows': rows['timelines'],
+        'timeline_rows_per_sec': rows['timelines'] / wall,
+        # seconds summed over all chunks, so they add up to more than the wall time with several workers
+        'stage_seconds': stage_seconds,
+        # every stage and counter, as saved by --profile-output
+        'profile': {stage: {'seconds': seconds, 'calls': calls} for stage, (seconds, calls) in profiler.stages.items()},
+        'peak_rss_mb': peak_rss_mb(backend),
+    }
+
+
+def run_isolated(reference, bundle, **options):
+    """
+    Run a single benchmark scenario in a fresh process, so that its peak memory
+    is its own rather than that of the largest scenario run so far
+    Parameters:
+        reference: a tuple of country, demographic index, deprivation index, ages and modules
+        bundle: location of the compiled bundle the reference data was loaded from, if any
+        options: the keyword arguments of run_scenario
+    Returns:
+        a dictionary of results
+    """
+    with ProcessPoolExecutor(max_workers=1) as pool:
+        return pool.submit(run_scenario, reference, bundle, **options).result()
+
+
+@click.command()
+@click.option('--population', '-p', 'populations', multiple=True, type=int, default=[1000, 10000, 100000], \
+                help='Population sizes to benchmark, can be given more than once')
+@click.option('--modules', '-m', 'module_counts', multiple=True, type=int, \
+                help='Numbers of modules to run, in config order, all of them by default')
+@click.option('--workers', '-w', 'worker_counts', multiple=True, type=click.IntRange(min=1), \
+                help='Numbers of workers to benchmark, 1 and the CPU count by default, ignored by the serial backend')
+@click.option('--backend', default='process', type=click.Choice(BACKENDS), \
+                help='Run tasks serially, in worker processes or in threads')
+@click.option('--engine', default='scalar', type=click.Choice(ENGINES), \
+                help='Generate patients one at a time, or vectorised over each chunk')
+@click.option('--format', 'output_format', default='csv', type=click.Choice(FORMATS), \
+                help='Write output as CSV, Parquet or Arrow files')
+@click.option('--compression', default='none', type=click.Choice(list(COMPRESSIONS)), \
+                help='Compress the output files with gzip or zstd')
+@click.option('--seed', default=0, help='Seed used for every scenario')
+@click.option('--chunk-size', default=10000, type=click.IntRange(min=1), \
+                help='How many patients to generate in a single task')
+@click.option('--max-pending', default=10, type=click.IntRange(min=1), \
+                help='How many tasks to have submitted at any one time')
+@click.option('--cache-size', default=1024, type=click.IntRange(0), \
+                help='How many static profiles each worker keeps posterior probabilities for, 0 to disable')
+@click.option('--stages/--no-stages', default=True, \
+                help='Time each stage as --profile does, which slows generation slightly')
+@click.option('--output', '-o', type=click.Path(dir_okay=False), \
+                help='File to save the JSON results to, printed by default')
+def bench(populations, module_counts, worker_counts, backend, engine, output_format, compression, seed, chunk_size, \
+          max_pending, cache_size, stages, output):
+    """Benchmark generation throughput over fixed-seed scenarios."""
+    # keep stdout for the JSON report
+    tic = perf_counter()
+    with redirect_stdout(sys.stderr):
+        bundle = find_bundle()
+        reference = generator_set_up(REFERENCE_DATE, bundle)
+    setup = perf_counter() - tic
+
+    module_counts = module_counts or [len(reference[4])]
+    # the serial backend runs every task in the main process, whatever the number of workers
+    if backend == 'serial':
+        worker_counts = [None]
+    worker_counts = worker_counts or sorted({1, os.cpu_count()})
+
+    scenarios = []
+    for population in populations:
+        for module_count in module_counts:
+            for workers in worker_counts:
+                print(f"Benchmarking {population:,} patients, {module_count} modules, " \
+                      f"{workers or 'no'} workers", file=sys.stderr)
+                result = run_isolated(reference, bundle, population=population, module_count=module_count, \
+                                      workers=workers, backend=backend, engine=engine, output_format=output_format, \
+                                      compression=compression, seed=seed, chunk_size=chunk_size, \
+                                      max_pending=max_pending, cache_size=cache_size, stages=stages)
+                result['stage_seconds'] = {'setup': setup, **result['stage_seconds']}
+                scenarios.append(result)
+
+    report = {
+        'created': datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'scenarios': scenarios,
+    }
+    if output:
+        with open(output, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
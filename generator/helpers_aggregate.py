@@ -0,0 +1,92 @@
+#!/usr/bin/python3
+import numpy as np
+
+from .helpers_timelines import recode
+
+# patient attributes prevalence is broken down by, besides the age range
+STRATA = ['region', 'ethnicity', 'gender', 'deprivation_level']
+
+# a helper function listing every value of each stratum
+def strata_vocabularies(demographic_index, deprivation):
+  """
+  List every possible value of each stratum
+  Parameters:
+    demographic_index: a DemographicIndex
+    deprivation: a DeprivationIndex
+  Returns:
+    a dictionary of lists of values by stratum, in the order of STRATA
+  """
+  return {
+    'region': demographic_index.regions,
+    'ethnicity': list(dict.fromkeys(demographic_index.ethnicities)),
+    'gender': demographic_index.genders,
+    'deprivation_level': sorted(set(deprivation.by_area.tolist())),
+  }
+
+# count module states by stratum and age range
+def count_states(patients, bands, timelines, ages, modules, vocabularies):
+  """
+  Count the states of each module by stratum and age range, over every age
+  range each patient has lived through, as the rows of the timelines output,
+  leaving out age ranges before a module's first state
+  Parameters:
+    patients: a PatientBatch, as returned by generate_patients_batch
+    bands: an integer array of each patient's current age range index
+    timelines: a dictionary of state indices by module, from run_timelines_batch
+    ages: a list of age ranges
+    modules: a dictionary of CompiledModule by module name
+    vocabularies: a dictionary of lists of values by stratum, from strata_vocabularies
+  Returns:
+    counts: a dictionary of count arrays (strata... x age ranges x states) by module
+  """
+  shape = tuple(len(vocabularies[stratum]) for stratum in STRATA)
+  # categorical strata keep the batch's codes, deprivation levels are numbers in a sorted vocabulary
+  codes = [recode(patients, stratum, vocabularies[stratum]) if stratum in patients.vocabularies \
+           else np.searchsorted(vocabularies[stratum], getattr(patients, stratum)) for stratum in STRATA]
+  stratum = np.ravel_multi_index(codes, shape)
+  # one entry per patient per age range lived through
+  patient, band = np.nonzero(np.arange(len(ages))[None, :] <= bands[:, None])
+  counts = {}
+  for module, data in modules.items():
+    states = len(data.states)
+    state = timelines[module][patient, band]
+    known = state < states
+    key = (stratum[patient[known]] * len(ages) + band[known]) * states + state[known]
+    size = np.prod(shape) * len(ages) * states
+    counts[module] = np.bincount(key, minlength=size).reshape(shape + (len(ages), states))
+  return counts
+
+# add one set of counts to another
+def merge_counts(total, counts):
+  """
+  Add counts from a chunk to the running totals
+  Parameters:
+    total: a dictionary of count arrays by module, None to start from nothing
+    counts: a dictionary of count arrays by module
+  Returns:
+    the updated totals
+  """
+  if total is None:
+    return {module: array.copy() for module, array in counts.items()}
+  for module, array in counts.items():
+    total[module] += array
+  return total
+
+# a helper function flattening counts into rows
+def prevalence_rows(counts, vocabularies, ages, modules):
+  """
+  Flatten counts into rows, leaving out empty cells
+  Parameters:
+    counts: a dictionary of count arrays by module
+    vocabularies: a dictionary of lists of values by stratum
+    ages: a list of age ranges
+    modules: a dictionary of CompiledModule by module name
+  Returns:
+    a generator of rows: strata, age_range, module, state and count
+  """
+  strata = [vocabularies[stratum] for stratum in STRATA]
+  for module, array in counts.items():
+    for cell in zip(*np.nonzero(array)):
+      *position, band, state = cell
+      yield [values[i] for values, i in zip(strata, position)] + \
+        [ages[band], module, modules[module].states[state], int(array[cell])]
@@ -0,0 +1,181 @@
+#!/usr/bin/python3
+import numpy as np
+
+# available output formats
+FORMATS = ('csv', 'parquet', 'arrow')
+
+# a helper function importing pyarrow, which is an optional dependency
+def import_pyarrow():
+  """
+  Import pyarrow, with a helpful message if it is not installed
+  Parameters:
+    None
+  Returns:
+    the pyarrow module
+  """
+  try:
+    import pyarrow
+  except ImportError:
+    raise ImportError("Parquet and Arrow output require pyarrow, install it with "
+                      "`pip install SynthethicHealthPopulation[arrow]`") from None
+  return pyarrow
+
+# a helper function building an arrow schema
+def build_schema(columns, vocabularies, types={}, metadata=None):
+  """
+  Build an arrow schema, dictionary encoding the categorical columns
+  Parameters:
+    columns: list of column names, in order
+    vocabularies: a dictionary of all possible values by categorical column name
+    types: a dictionary of arrow types by column name, string by default
+    metadata: a dictionary of strings stored with the schema
+  Returns:
+    a pyarrow Schema
+  """
+  pa = import_pyarrow()
+  fields = []
+  for column in columns:
+    if column in vocabularies:
+      fields.append(pa.field(column, pa.dictionary(pa.int32(), pa.string())))
+    else:
+      fields.append(pa.field(column, types.get(column, pa.string())))
+  return pa.schema(fields, metadata=metadata)
+
+class ArrowWriter:
+  """
+  A buffered writer appending rows to a Parquet or Arrow IPC file.
+  Rows, or chunks already held as columns, are collected in memory and
+  written out as one row group (or record batch) every `buffer_size` rows.
+  Categorical columns are dictionary encoded against a fixed vocabulary, so
+  every row group shares the same dictionary. Values outside it, such as the
+  empty state of a module before its first one, are written as nulls.
+
+  Attributes
+  ----------
+  location: file location, incl file name
+  schema: a pyarrow Schema, as returned by build_schema
+  vocabularies: a dictionary of all possible values by categorical column name
+  output_format: either `parquet` or `arrow`
+  buffer_size: number of rows to collect before writing them out
+  compression: `gzip` or `zstd` to compress the data, `none` for pyarrow's default
+  """
+
+  def __init__(self, location, schema, vocabularies, output_format='parquet', buffer_size=10000, compression='none'):
+    pa = import_pyarrow()
+    self.location = location
+    self.schema = schema
+    self.buffer_size = buffer_size
+    self.buffer = []
+    # tables of rows written since the last row group, and their number of rows
+    self.tables = []
+    self.pending = 0
+    # dictionaries and value to index lookups for the categorical columns
+    self.dictionaries = {column: pa.array(values, type=pa.string()) \
+                         for column, values in vocabularies.items()}
+    self.codes = {column: {value: i for i, value in enumerate(values)} \
+                  for column, values in vocabularies.items()}
+    if output_format == 'parquet':
+      import pyarrow.parquet as pq
+      codec = {} if compression == 'none' else {'compression': compression}
+      self.writer = pq.ParquetWriter(location, schema, **codec)
+    elif output_format == 'arrow':
+      # Arrow IPC files support zstd but not gzip
+      if compression not in ('none', 'zstd'):
+        raise ValueError(f"Arrow files cannot be compressed with {compression}, only zstd")
+      options = pa.ipc.IpcWriteOptions(compression=None if compression == 'none' else compression)
+      self.writer = pa.ipc.new_file(location, schema, options=options)
+    else:
+      raise ValueError(f"Unknown output format {output_format}, expected parquet or arrow")
+
+  def write(self, rows):
+    """
+    Add rows to the buffer, writing it out when full
+    Parameters:
+      rows: an iterable of rows
+    Returns:
+      None
+    """
+    self.buffer.extend(rows)
+    if len(self.buffer) + self.pending >= self.buffer_size:
+      self.flush()
+
+  def write_columns(self, columns):
+    """
+    Add a chunk held as columns, after any buffered rows, writing them out when full.
+    Coded columns are mapped to the writer's dictionaries once per vocabulary value.
+    Parameters:
+      columns: a Columns chunk
+    Returns:
+      None
+    """
+    pa = import_pyarrow()
+    self.table_rows()
+    arrays = []
+    for field in self.schema:
+      values = columns.columns[field.name]
+      if field.name in self.codes and field.name in columns.vocabularies:
+        codes = self.codes[field.name]
+        recode = np.array([codes.get(value, -1) for value in columns.vocabularies[field.name]], dtype=np.int32)
+        indices = recode[values]
+        arrays.append(pa.DictionaryArray.from_arrays(pa.array(indices, mask=indices < 0), \
+                                                     self.dictionaries[field.name]))
+      elif field.name in self.codes:
+        arrays.append(self.encode(field.name, values.tolist()))
+      else:
+        arrays.append(pa.array(values, type=field.type))
+    self.tables.append(pa.Table.from_arrays(arrays, schema=self.schema))
+    self.pending += len(columns)
+    if self.pending >= self.buffer_size:
+      self.flush()
+
+  def encode(self, column, values):
+    """
+    Dictionary encode a list of values of a categorical column
+    """
+    pa = import_pyarrow()
+    codes = self.codes[column]
+    indices = pa.array([codes.get(value) for value in values], type=pa.int32())
+    return pa.DictionaryArray.from_arrays(indices, self.dictionaries[column])
+
+  def table_rows(self):
+    """
+    Move the buffered rows into a table waiting to be written
+    """
+    if not self.buffer:
+      return
+    pa = import_pyarrow()
+    arrays = []
+    for field, values in zip(self.schema, zip(*self.buffer)):
+      if field.name in self.codes:
+        arrays.append(self.encode(field.name, values))
+      else:
+        arrays.append(pa.array(values, type=field.type))
+    self.tables.append(pa.Table.from_arrays(arrays, schema=self.schema))
+    self.pending += len(self.buffer)
+    self.buffer = []
+
+  def flush(self):
+    """
+    Write out all buffered rows as a single row group
+    """
+    self.table_rows()
+    if not self.tables:
+      return
+    pa = import_pyarrow()
+    table = self.tables[0] if len(self.tables) == 1 else pa.concat_tables(self.tables).combine_chunks()
+    self.writer.write_table(table)
+    self.tables = []
+    self.pending = 0
+
+  def close(self):
+    """
+    Write out remaining rows and close the file
+    """
+    self.flush()
+    self.writer.close()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exc):
+    self.close()
@@ -0,0 +1,283 @@
+#!/usr/bin/python3
+import hashlib
+import json
+import os
+import shutil
+import numpy as np
+from dataclasses import fields
+from pandas import to_numeric
+
+from .helpers_patient import DemographicIndex, DeprivationIndex, dob_ranges
+from .helpers_timelines import CharRule, CompiledModule
+
+# bumped whenever the layout of a bundle changes, so old bundles are not loaded
+BUNDLE_VERSION = 1
+# directory compiled bundles are kept in
+BUNDLE_DIR = 'cache'
+
+# columns every input file must have
+DEMOGRAPHIC_COLUMNS = ['Region', 'Area', 'Ethnicity', 'Population', 'Male', 'Female']
+DEPRIVATION_COLUMNS = ['area', 'NZDep2018']
+MODULE_COLUMNS = ['type', 'variable', 'value']
+MODULE_TYPES = ['PriorInitialProb', 'PriorTransProb', 'StaticChar', 'DynamicChar']
+
+# DemographicIndex attributes depending on the reference date, calculated when loading
+DATED = ('reference_date', 'dob_start', 'dob_span')
+
+# a helper function hashing the reference data of a run
+def input_digest(country, inputs):
+  """
+  Hash the contents of every input file, together with the name it is used under
+  Parameters:
+    country: specified country to generate patients for
+    inputs: a dictionary of file paths by name, in config order
+  Returns:
+    a hex digest
+  """
+  digest = hashlib.sha256(f"{BUNDLE_VERSION}:{country}".encode())
+  for name, path in inputs.items():
+    digest.update(f"\n{name}:{os.path.basename(path)}\n".encode())
+    with open(path, 'rb') as f:
+      for block in iter(lambda: f.read(2**20), b''):
+        digest.update(block)
+  return digest.hexdigest()
+
+# a helper function for the location of a bundle
+def bundle_location(digest, directory=BUNDLE_DIR):
+  """
+  Directory a bundle compiled from the given inputs is kept in
+  Parameters:
+    digest: hex digest of the inputs, from input_digest
+    directory: directory bundles are kept in
+  Returns:
+    a path
+  """
+  return os.path.join(directory, digest[:16])
+
+# a helper function finding cells that are not numbers
+def to_numbers(data):
+  """
+  Convert every cell of a dataframe to a number, listing the cells that are not numbers
+  Parameters:
+    data: a dataframe read from a csv file
+  Returns:
+    values: a dataframe of numbers, NaN where a cell is empty or not a number
+    cells: a list of non-empty cells that are not numbers, as `column on line n` of the csv file
+  """
+  values = data.apply(to_numeric, errors='coerce')
+  invalid = values.isna() & data.notna()
+  # line 1 of the file is the header
+  cells = [f"{column} on line {position + 2}" for column in data.columns \
+           for position in np.flatnonzero(invalid[column].to_numpy())]
+  return values, cells
+
+# a helper function describing a list of cells in a problem
+def describe_cells(cells, limit=5):
+  """
+  Join the first few cells of a list, counting the rest
+  Parameters:
+    cells: a list of cell descriptions
+    limit: number of cells to list
+  Returns:
+    a string
+  """
+  listed = ', '.join(cells[:limit])
+  return listed if len(cells) <= limit else f"{listed} and {len(cells) - limit} more"
+
+# check the demographics before compiling them
+def validate_demographics(demographics, ages):
+  """
+  Check the demographics have the columns and values the generator relies on
+  Parameters:
+    demographics: a dataframe of demographics
+    ages: a list of age ranges
+  Returns:
+    a list of problems, empty if there are none
+  """
+  missing = [column for column in DEMOGRAPHIC_COLUMNS if column not in demographics.columns]
+  if missing:
+    return [f"demographics are missing columns {', '.join(missing)}"]
+  problems = []
+  age_columns = demographics.columns[6:24].tolist()
+  if age_columns != ages:
+    problems.append(f"demographics age columns {', '.join(age_columns)} do not match {', '.join(ages)}")
+  numeric = demographics[['Population', 'Male', 'Female'] + age_columns]
+  values, cells = to_numbers(numeric)
+  if numeric.isna().any().any():
+    problems.append("demographics have empty population or proportion values")
+  elif cells:
+    problems.append(f"demographics have population or proportion values that are not numbers: {describe_cells(cells)}")
+  elif (values < 0).any().any():
+    problems.append("demographics have negative population or proportion values")
+  if values['Population'].sum() <= 0:
+    problems.append("demographics have no population")
+  return problems
+
+# check the deprivation scores before compiling them
+def validate_deprivation(deprivation):
+  """
+  Check the deprivation scores have the columns the generator relies on
+  Parameters:
+    deprivation: a dataframe of deprivation scores
+  Returns:
+    a list of problems, empty if there are none
+  """
+  missing = [column for column in DEPRIVATION_COLUMNS if column not in deprivation.columns]
+  if missing:
+    return [f"deprivation scores are missing columns {', '.join(missing)}"]
+  if deprivation['NZDep2018'].isna().any():
+    return ["deprivation scores have empty values"]
+  return []
+
+# check a module before compiling it
+def validate_module(module, data):
+  """
+  Check a module's input data has the columns, row types and probabilities
+  the generator relies on
+  Parameters:
+    module: module name
+    data: a dataframe of input settings
+  Returns:
+    a list of problems, empty if there are none
+  """
+  missing = [column for column in MODULE_COLUMNS if column not in data.columns]
+  if missing:
+    return [f"module {module} is missing columns {', '.join(missing)}"]
+  problems = []
+  unknown = sorted(set(data['type'].dropna()) - set(MODULE_TYPES))
+  if unknown:
+    problems.append(f"module {module} has unknown row types {', '.join(unknown)}")
+  states = data.iloc[:,3:-1]
+  if states.empty:
+    problems.append(f"module {module} has no states")
+  elif states.isna().any().any():
+    problems.append(f"module {module} has empty probabilities or multipliers")
+  else:
+    values, cells = to_numbers(states)
+    if cells:
+      problems.append(f"module {module} has probabilities or multipliers that are not numbers: {describe_cells(cells)}")
+    elif (values < 0).any().any():
+      problems.append(f"module {module} has negative probabilities or multipliers")
+  return problems
+
+# a helper function converting a module to JSON types
+def module_to_dict(data):
+  """
+  Convert a CompiledModule to a dictionary of JSON types
+  Parameters:
+    data: a CompiledModule
+  Returns:
+    a dictionary
+  """
+  def rules(chars):
+    return [{'variable': char.variable, 'value': char.value, 'operator': char.operator, \
+             'threshold': char.threshold, 'mult': char.mult.tolist()} for char in chars]
+  return {
+    'name': data.name,
+    'states': data.states,
+    'initial_prob': {age_range: prob.tolist() for age_range, prob in data.initial_prob.items()},
+    'trans_prob': data.trans_prob.tolist(),
+    'static_char': rules(data.static_char),
+    'dynamic_char': rules(data.dynamic_char),
+  }
+
+# a helper function converting a module back from JSON types
+def module_from_dict(data):
+  """
+  Convert a dictionary from module_to_dict back to a CompiledModule
+  Parameters:
+    data: a dictionary
+  Returns:
+    a CompiledModule
+  """
+  def rules(chars):
+    return [CharRule(char['variable'], char['value'], char['operator'], char['threshold'], \
+                     np.array(char['mult'])) for char in chars]
+  return CompiledModule(
+    name=data['name'],
+    states=data['states'],
+    initial_prob={age_range: np.array(prob) for age_range, prob in data['initial_prob'].items()},
+    trans_prob=np.array(data['trans_prob']),
+    static_char=rules(data['static_char']),
+    dynamic_char=rules(data['dynamic_char']),
+  )
+
+# save the compiled reference data
+def save_bundle(location, digest, country, demographic_index, deprivation, modules):
+  """
+  Save compiled reference data as one .npy file per array, which can be
+  memory-mapped, and a JSON file of vocabularies and modules. The bundle is
+  written to a temporary directory first, so it is never seen half written.
+  Parameters:
+    location: directory to save the bundle to, from bundle_location
+    digest: hex digest of the inputs, from input_digest
+    country: specified country to generate patients for
+    demographic_index: a DemographicIndex
+    deprivation: a DeprivationIndex
+    modules: a dictionary of CompiledModule by module name
+  Returns:
+    None
+  """
+  temporary = f"{location}.tmp{os.getpid()}"
+  shutil.rmtree(temporary, ignore_errors=True)
+  os.makedirs(temporary)
+
+  lists = {}
+  for attribute in fields(DemographicIndex):
+    if attribute.name in DATED:
+      continue
+    value = getattr(demographic_index, attribute.name)
+    if isinstance(value, np.ndarray):
+      np.save(os.path.join(temporary, f"demographics.{attribute.name}.npy"), value)
+    else:
+      lists[attribute.name] = value
+  np.save(os.path.join(temporary, "deprivation.by_area.npy"), deprivation.by_area)
+
+  metadata = {
+    'version': BUNDLE_VERSION,
+    'digest': digest,
+    'country': country,
+    'demographics': lists,
+    'deprivation': {'scores': deprivation.scores, 'fallback': deprivation.fallback, \
+                    'unmatched': deprivation.unmatched},
+    'modules': [module_to_dict(data) for data in modules.values()],
+  }
+  with open(os.path.join(temporary, 'bundle.json'), 'w') as f:
+    json.dump(metadata, f)
+
+  # replace any earlier bundle compiled from the same inputs
+  shutil.rmtree(location, ignore_errors=True)
+  os.replace(temporary, location)
+
+# load compiled reference data
+def load_bundle(location, reference_date):
+  """
+  Load a bundle saved by save_bundle, memory-mapping its arrays
+  Parameters:
+    location: directory the bundle was saved to
+    reference_date: the date ages are calculated at
+  Returns:
+    country: specified country to generate patients for
+    demographic_index: a DemographicIndex
+    deprivation: a DeprivationIndex
+    modules: a dictionary of CompiledModule by module name
+  """
+  with open(os.path.join(location, 'bundle.json')) as f:
+    metadata = json.load(f)
+  if metadata['version'] != BUNDLE_VERSION:
+    raise ValueError(f"Bundle {location} has version {metadata['version']}, expected {BUNDLE_VERSION}")
+
+  def array(name):
+    return np.load(os.path.join(location, f"{name}.npy"), mmap_mode='r')
+
+  values = dict(metadata['demographics'])
+  for attribute in fields(DemographicIndex):
+    if attribute.name not in DATED and attribute.name not in values:
+      values[attribute.name] = array(f"demographics.{attribute.name}")
+  dob_start, dob_span = dob_ranges(values['age_ranges'], reference_date)
+  demographic_index = DemographicIndex(**values, reference_date=reference_date, \
+                                       dob_start=dob_start, dob_span=dob_span)
+
+  deprivation = DeprivationIndex(by_area=array("deprivation.by_area"), **metadata['deprivation'])
+  modules = {data['name']: module_from_dict(data) for data in metadata['modules']}
+  return metadata['country'], demographic_index, deprivation, modules
@@ -1,17 +1,85 @@
 #!/usr/bin/python3
 import csv
+import gzip
+import io
+import numpy as np
+
+from .helpers_journal import commit_file
+
+# available compressions of csv output, and the extension each adds to file names
+COMPRESSIONS = {'none': '', 'gzip': '.gz', 'zstd': '.zst'}
+
+# a helper function importing zstandard, which is an optional dependency
+def import_zstandard():
+  """
+  Import zstandard, with a helpful message if it is not installed
+  Parameters:
+    None
+  Returns:
+    the zstandard module
+  """
+  try:
+    import zstandard
+  except ImportError:
+    raise ImportError("zstd compression requires zstandard, install it with "
+                      "`pip install SynthethicHealthPopulation[zstd]`") from None
+  return zstandard
+
+# a helper function starting a compressed stream
+def open_compressed(raw, compression):
+  """
+  Start a gzip member or zstd frame at the end of an open binary file.
+  Closing the returned stream finishes the member or frame and leaves the
+  file open, and members and frames written one after another read back as
+  a single stream.
+  Parameters:
+    raw: a binary file opened for appending
+    compression: either `gzip` or `zstd`
+  Returns:
+    a text stream
+  """
+  if compression == 'gzip':
+    # no timestamp, so that seeded runs give identical files
+    stream = gzip.GzipFile(fileobj=raw, mode='wb', compresslevel=6, mtime=0)
+  elif compression == 'zstd':
+    stream = import_zstandard().ZstdCompressor().stream_writer(raw, closefd=False)
+  else:
+    raise ValueError(f"Unknown compression {compression}, expected one of {', '.join(COMPRESSIONS)}")
+  return io.TextIOWrapper(stream, encoding='utf-8', newline='')
+
+# a helper function opening a possibly compressed csv file for reading
+def open_text(location, compression='none'):
+  """
+  Open a csv file for reading, decompressing it if needed
+  Parameters:
+    location: file location, incl file name
+    compression: one of `none`, `gzip` or `zstd`
+  Returns:
+    a text stream
+  """
+  if compression == 'gzip':
+    return gzip.open(location, 'rt', encoding='utf-8', newline='')
+  if compression == 'zstd':
+    reader = import_zstandard().ZstdDecompressor().stream_reader(open(location, 'rb'), read_across_frames=True)
+    return io.TextIOWrapper(reader, encoding='utf-8', newline='')
+  return open(location, newline='')
 
 
 # a helper function creates a new empty csv file
-def create_csv(location, headers):
+def create_csv(location, headers, compression='none'):
   """
   Create an empty csv file with set headers
   Parameters:
     location: file location, incl file name
     headers: list of headers to use
+    compression: one of `none`, `gzip` or `zstd`
   Returns:
     None
   """
+  if compression != 'none':
+    with open(location, 'wb') as raw, open_compressed(raw, compression) as f:
+      f.write(headers + "\n")
+    return
   with open(location, 'w') as f:
     f.write(headers + "\n")
     f.close
@@ -30,4 +98,134 @@ def append_to_csv(location, data):
         writer = csv.writer(f)
         writer.writerows(data)
 
+# characters that make csv.writer quote a field
+QUOTED = ',"\r\n'
+
+# a helper function formatting strings as csv fields
+def csv_fields(values):
+  """
+  Format strings as csv fields, quoting them as csv.writer does
+  Parameters:
+    values: a list of strings
+  Returns:
+    a list of csv fields
+  """
+  # most columns never need quoting, which one search over all of them shows
+  text = '\x00'.join(values)
+  if not any(char in text for char in QUOTED):
+    return values
+  return ['"' + value.replace('"', '""') + '"' if any(char in value for char in QUOTED) else value \
+          for value in values]
+
+# a helper function formatting a chunk of columns as csv text
+def format_columns(columns):
+  """
+  Format a chunk held as columns as csv lines, exactly as csv.writer writes
+  the same rows. Categorical columns are formatted once per vocabulary value.
+  Parameters:
+    columns: a Columns chunk, of strings, numbers and dates
+  Returns:
+    a string of csv lines
+  """
+  if len(columns) == 0:
+    return ''
+  fields = []
+  for column, values in columns.columns.items():
+    if column in columns.vocabularies:
+      vocabulary = csv_fields(list(map(str, columns.vocabularies[column])))
+      fields.append(np.array(vocabulary, dtype=object)[values].tolist())
+    elif values.dtype.kind in 'OU':
+      fields.append(csv_fields(list(map(str, values.tolist()))))
+    else:
+      # numbers, and dates as YYYY-MM-DD
+      fields.append(values.astype(str).tolist())
+  return '\r\n'.join(map(','.join, zip(*fields))) + '\r\n'
+
+class CSVWriter:
+  """
+  A buffered writer appending rows to a single open csv file.
+  Rows are collected in memory and written out in blocks of `buffer_size`,
+  so the number of rows held at any time does not depend on population size.
+  Compressed files are written as a stream of gzip members or zstd frames,
+  a new one starting at every commit.
+
+  Attributes
+  ----------
+  location: file location, incl file name
+  buffer_size: number of rows to collect before writing them out
+  compression: one of `none`, `gzip` or `zstd`
+  """
+
+  def __init__(self, location, buffer_size=10000, compression='none'):
+    self.location = location
+    self.buffer_size = buffer_size
+    self.compression = compression
+    self.buffer = []
+    if compression == 'none':
+      self.raw = None
+      self.file = open(location, 'a', newline='')
+    else:
+      self.raw = open(location, 'ab')
+      self.file = open_compressed(self.raw, compression)
+    self.writer = csv.writer(self.file)
+
+  def write(self, rows):
+    """
+    Add rows to the buffer, writing it out when full
+    Parameters:
+      rows: an iterable of rows
+    Returns:
+      None
+    """
+    self.buffer.extend(rows)
+    if len(self.buffer) >= self.buffer_size:
+      self.flush()
+
+  def write_columns(self, columns):
+    """
+    Write out a chunk held as columns, after any buffered rows
+    Parameters:
+      columns: a Columns chunk
+    Returns:
+      None
+    """
+    self.flush()
+    self.file.write(format_columns(columns))
+
+  def flush(self):
+    """
+    Write out all buffered rows
+    """
+    self.writer.writerows(self.buffer)
+    self.buffer = []
+
+  def commit(self):
+    """
+    Write out all buffered rows and flush them to disk
+    Returns:
+      the file's size, as an offset to truncate it back to
+    """
+    self.flush()
+    if self.raw is None:
+      return commit_file(self.file)
+    # finish the member or frame, so the file can be truncated back to here
+    self.file.close()
+    offset = commit_file(self.raw)
+    self.file = open_compressed(self.raw, self.compression)
+    self.writer = csv.writer(self.file)
+    return offset
+
+  def close(self):
+    """
+    Write out remaining rows and close the file
+    """
+    self.flush()
+    self.file.close()
+    if self.raw is not None:
+      self.raw.close()
+
+  def __enter__(self):
+    return self
 
+  def __exit__(self, *exc):
+    self.close()
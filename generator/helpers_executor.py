@@ -0,0 +1,77 @@
+#!/usr/bin/python3
+from concurrent.futures import Executor, Future, ProcessPoolExecutor, ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+# available execution backends
+BACKENDS = ('serial', 'process', 'thread')
+
+class SerialExecutor(Executor):
+  """
+  An executor running every task in the calling process as it is submitted.
+  Avoids all pool and pickling overhead, for small populations and profiling.
+  """
+
+  def __init__(self, initializer=None, initargs=()):
+    if initializer is not None:
+      initializer(*initargs)
+
+  def submit(self, fn, /, *args, **kwargs):
+    future = Future()
+    try:
+      future.set_result(fn(*args, **kwargs))
+    except BaseException as e:
+      future.set_exception(e)
+    return future
+
+# a helper function for setting up an executor
+def create_executor(backend, workers, initializer=None, initargs=()):
+  """
+  Create an executor for the selected backend
+  Parameters:
+    backend: one of `serial`, `process` or `thread`
+    workers: number of worker processes or threads, ignored for `serial`
+    initializer: a callable run once by each worker
+    initargs: arguments passed to the initializer
+  Returns:
+    an Executor
+  """
+  if backend == 'serial':
+    return SerialExecutor(initializer, initargs)
+  if backend == 'process':
+    return ProcessPoolExecutor(max_workers=workers, initializer=initializer, initargs=initargs)
+  if backend == 'thread':
+    return ThreadPoolExecutor(max_workers=workers, initializer=initializer, initargs=initargs)
+  raise ValueError(f"Unknown backend {backend}, expected one of {', '.join(BACKENDS)}")
+
+# a helper function running tasks with a bounded number in flight
+def run_in_order(pool, fn, tasks, max_pending, consume):
+  """
+  Submit tasks to an executor, keeping at most max_pending of them submitted
+  or finished but not yet consumed, and pass their results to consume in the
+  order the tasks are given, whichever finishes first
+  Parameters:
+    pool: an Executor
+    fn: the task function
+    tasks: an iterable of argument tuples for fn, in order
+    max_pending: maximum number of tasks submitted or waiting to be consumed, at least 1
+    consume: a callable taking a task's position in tasks and its result
+  Returns:
+    None
+  """
+  pending = {}
+  finished = {}
+  next_task = 0
+
+  def collect(done):
+    nonlocal next_task
+    for future in done:
+      finished[pending.pop(future)] = future.result()
+    while next_task in finished:
+      consume(next_task, finished.pop(next_task))
+      next_task += 1
+
+  for position, args in enumerate(tasks):
+    while len(pending) + len(finished) >= max_pending:
+      collect(wait(pending, return_when=FIRST_COMPLETED).done)
+    pending[pool.submit(fn, *args)] = position
+  while pending:
+    collect(wait(pending, return_when=FIRST_COMPLETED).done)
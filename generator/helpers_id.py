@@ -1,23 +1,25 @@
 #!/usr/bin/python3
-from random import randint, choice
+import random
+from functools import lru_cache
+import numpy as np
 
 # a helper function that generates a random id number
-def generate_random_id():
+def generate_random_id(rng=random):
   """
   Generate a random 7 digit id number
   Parameters:
-    none
+    rng: source of random numbers, the random module by default
   Returns:
     id: a randomly generated id number
   """
-  return ''.join(str(randint(0,9)) for _ in range(7))
+  return ''.join(str(rng.randint(0,9)) for _ in range(7))
 
 # a helper function that generates a New Zealand NHI number
-def generate_nhi_id():
+def generate_nhi_id(rng=random):
   """
   Generates a valid NHI number
   Parameters:
-    none
+    rng: source of random numbers, the random module by default
   Returns:
     id: a valid NHI number
   """
@@ -28,9 +30,9 @@ def generate_nhi_id():
   # iterate until a valid id is generated
   while not(valid):
     # generate 3 random letters
-    alpha = ''.join(choice(letters) for _ in range(3))
+    alpha = ''.join(rng.choice(letters) for _ in range(3))
     # generate 3 random numbers
-    numeric = ''.join(str(randint(0,9)) for _ in range(3))
+    numeric = ''.join(str(rng.randint(0,9)) for _ in range(3))
     # calculate the sum of letters
     alpha_values = [letters.index(char) + 1 for char in alpha]
     alpha_sum = sum([a * b for a, b in zip(alpha_values, [7, 6, 5])])
@@ -46,3 +48,187 @@ def generate_nhi_id():
       id = ''.join([alpha, numeric, str(check_digit)])
       return id
 
+
+# letters used in NHI numbers - does not contain `O` or `I`
+NHI_LETTERS = "ABCDEFGHJKLMNPQRSTUVWXYZ"
+
+@lru_cache(maxsize=None)
+def nhi_tables():
+  """
+  Tables enumerating every valid NHI number, ordered by letters then digits.
+  Whether digits are valid depends only on the letters' checksum modulo 11,
+  so the valid digits are listed once for each of the 11 residues.
+  Parameters:
+    none
+  Returns:
+    alpha: an array of letter indices for every 3 letter prefix (prefixes x 3)
+    residue: the letters' checksum modulo 11 for every prefix
+    cum: cumulative count of valid NHI numbers by prefix
+    numerics: valid 3 digit numbers for each residue, padded (11 x 1000)
+  """
+  n = len(NHI_LETTERS)
+  prefixes = np.arange(n ** 3)
+  alpha = np.stack([prefixes // n ** 2, prefixes // n % n, prefixes % n], axis=1)
+  residue = ((alpha + 1) @ np.array([7, 6, 5])) % 11
+  digits = np.arange(1000)
+  numeric_sum = (digits // 100) * 4 + (digits // 10 % 10) * 3 + (digits % 10) * 2
+  numerics = np.zeros((11, 1000), dtype=np.int64)
+  counts = np.zeros(11, dtype=np.int64)
+  for r in range(11):
+    valid = digits[(r + numeric_sum) % 11 != 0]
+    numerics[r, :len(valid)] = valid
+    counts[r] = len(valid)
+  return alpha, residue, np.cumsum(counts[residue]), numerics
+
+# a helper function counting valid NHI numbers
+def nhi_space_size():
+  """
+  Number of distinct valid NHI numbers
+  Parameters:
+    none
+  Returns:
+    an integer
+  """
+  return int(nhi_tables()[2][-1])
+
+# number of distinct 7 digit id numbers
+RANDOM_ID_SPACE = 10 ** 7
+
+# a helper function for the number of ids a country can give out
+def id_space_size(country):
+  """
+  Number of distinct ids generate_ids can give out for a country,
+  which is the largest population a run can have
+  Parameters:
+    country: specified country to generate patients for
+  Returns:
+    an integer
+  """
+  if country == 'NZ':
+    return nhi_space_size()
+  return RANDOM_ID_SPACE
+
+# number of Feistel rounds scramble applies
+FEISTEL_ROUNDS = 4
+
+# a helper function for the keyed round function of scramble
+def feistel_round(half, key, mask):
+  """
+  Mix one half of a Feistel block with a round key, as splitmix64 does
+  Parameters:
+    half: a uint64 array of half blocks
+    key: the round key, a uint64
+    mask: a uint64 keeping the bits of a half block
+  Returns:
+    a uint64 array of mixed values, each within mask
+  """
+  x = (half + key) * np.uint64(0xBF58476D1CE4E5B9)
+  x ^= x >> np.uint64(31)
+  x *= np.uint64(0x94D049BB133111EB)
+  return (x >> np.uint64(32)) & mask
+
+# a helper function mapping indices to distinct positions in an id space
+def scramble(index, size, entropy=0):
+  """
+  A seeded permutation of range(size), as a balanced Feistel network over
+  the smallest even number of bits covering size. Positions outside the id
+  space are cycle-walked, enciphered again until they fall within it, so
+  consecutive indices map to unrelated positions that never collide.
+  Parameters:
+    index: an integer array of positions, each less than size
+    size: number of ids in the id space
+    entropy: a seed choosing the permutation
+  Returns:
+    an integer array of distinct positions for distinct indices
+  """
+  bits = max(2, (int(size - 1).bit_length() + 1) // 2 * 2)
+  shift = np.uint64(bits // 2)
+  mask = np.uint64((1 << (bits // 2)) - 1)
+  keys = np.random.SeedSequence(entropy).generate_state(FEISTEL_ROUNDS, np.uint64)
+  position = np.array(index, dtype=np.uint64)
+  # every index is enciphered once, then again while it lands outside the id space
+  walk = np.ones(len(position), dtype=bool)
+  while walk.any():
+    left, right = position[walk] >> shift, position[walk] & mask
+    for key in keys:
+      left, right = right, left ^ feistel_round(right, key, mask)
+    position[walk] = (left << shift) | right
+    walk = position >= size
+  return position.astype(np.int64)
+
+# a helper function turning ascii codes into strings
+def codes_to_strings(codes):
+  """
+  Turn rows of ascii codes into strings
+  Parameters:
+    codes: a uint8 array (ids x characters)
+  Returns:
+    a list of strings
+  """
+  codes = np.ascontiguousarray(codes, dtype=np.uint8)
+  return codes.view(f'S{codes.shape[1]}').ravel().astype(str).tolist()
+
+# a helper function generating many NHI numbers at once
+def generate_nhi_ids(start, count, entropy=0):
+  """
+  Generate valid NHI numbers for patients start to start + count of a run.
+  Each patient position maps to a different NHI number, so ids never repeat
+  within a run, however its patients are split into chunks.
+  Parameters:
+    start: position of the first patient in the run
+    count: number of ids to generate
+    entropy: the run's seed
+  Returns:
+    ids: a list of valid NHI numbers
+  """
+  alpha, residue, cum, numerics = nhi_tables()
+  size = nhi_space_size()
+  if start + count > size:
+    raise ValueError(f"Only {size:,} distinct NHI numbers exist, cannot generate {start + count:,}")
+  position = scramble(np.arange(start, start + count), size, entropy)
+  # find the letters, then the rank of the digits among the valid ones
+  prefix = np.searchsorted(cum, position, side='right')
+  rank = position - np.where(prefix > 0, cum[prefix - 1], 0)
+  letters = alpha[prefix]
+  numeric = numerics[residue[prefix], rank]
+  digits = np.stack([numeric // 100, numeric // 10 % 10, numeric % 10], axis=1)
+  # calculate the check digit
+  check_sum = ((letters + 1) @ np.array([7, 6, 5]) + digits @ np.array([4, 3, 2])) % 11
+  check_digit = (11 - check_sum) % 10
+  codes = np.concatenate([np.frombuffer(NHI_LETTERS.encode(), dtype=np.uint8)[letters], \
+                          ord('0') + digits, ord('0') + check_digit[:, None]], axis=1)
+  return codes_to_strings(codes)
+
+# a helper function generating many random id numbers at once
+def generate_random_ids(start, count, entropy=0):
+  """
+  Generate distinct 7 digit id numbers for patients start to start + count of a run
+  Parameters:
+    start: position of the first patient in the run
+    count: number of ids to generate
+    entropy: the run's seed
+  Returns:
+    ids: a list of 7 digit id numbers
+  """
+  size = RANDOM_ID_SPACE
+  if start + count > size:
+    raise ValueError(f"Only {size:,} distinct 7 digit ids exist, cannot generate {start + count:,}")
+  number = scramble(np.arange(start, start + count), size, entropy)
+  digits = number[:, None] // 10 ** np.arange(6, -1, -1) % 10
+  return codes_to_strings(ord('0') + digits)
+
+# a helper function generating ids for a country
+def generate_ids(country, start, count, entropy=0):
+  """
+  Generate distinct ids, NHI numbers for NZ and 7 digit numbers otherwise
+  Parameters:
+    country: specified country to generate patients for
+    start: position of the first patient in the run
+    count: number of ids to generate
+    entropy: the run's seed
+  Returns:
+    ids: a list of ids
+  """
+  if country == 'NZ':
+    return generate_nhi_ids(start, count, entropy)
+  return generate_random_ids(start, count, entropy)
@@ -0,0 +1,102 @@
+#!/usr/bin/python3
+import json
+import os
+
+# name of the progress journal written next to the output files
+JOURNAL = 'progress.jsonl'
+
+# a helper function making everything written to a file durable
+def commit_file(f):
+  """
+  Flush a file to disk
+  Parameters:
+    f: an open file
+  Returns:
+    the file's size, as an offset to truncate it back to
+  """
+  f.flush()
+  os.fsync(f.fileno())
+  return f.tell()
+
+# load the progress of an earlier run
+def read_journal(location):
+  """
+  Read a progress journal, ignoring a last line cut short by the run being killed
+  Parameters:
+    location: file location, incl file name
+  Returns:
+    run: the run's settings, as given to Journal
+    last: the last committed chunk, None if no chunk was committed
+    complete: boolean, whether the run finished
+  """
+  run, last, complete = None, None, False
+  with open(location) as f:
+    for line in f:
+      try:
+        entry = json.loads(line)
+      except ValueError:
+        break
+      if 'run' in entry:
+        run = entry['run']
+      elif 'chunk' in entry:
+        last = entry
+      elif entry.get('complete'):
+        complete = True
+  if run is None:
+    raise ValueError(f"{location} does not start with the run's settings")
+  return run, last, complete
+
+class Journal:
+  """
+  An append-only record of the chunks committed to the output files.
+  A chunk is committed once its rows are on disk and its journal line is
+  written, so a run killed at any point resumes from its last complete line.
+
+  Attributes
+  ----------
+  location: file location, incl file name
+  file: the open journal
+  """
+
+  def __init__(self, location, run=None):
+    """
+    Open a journal, starting a new one with the run's settings if run is given
+    """
+    self.location = location
+    self.file = open(location, 'w' if run is not None else 'a')
+    if run is not None:
+      self.write({'run': run})
+
+  def write(self, entry):
+    """
+    Append an entry and flush it to disk
+    """
+    self.file.write(json.dumps(entry) + '\n')
+    commit_file(self.file)
+
+  def commit(self, chunk, offsets, rows):
+    """
+    Record a chunk as committed
+    Parameters:
+      chunk: index of the chunk
+      offsets: size of each output file once the chunk is written, by name
+      rows: number of rows written so far, by name
+    Returns:
+      None
+    """
+    self.write({'chunk': chunk, 'offsets': offsets, 'rows': rows})
+
+  def complete(self):
+    """
+    Record the run as finished
+    """
+    self.write({'complete': True})
+
+  def close(self):
+    self.file.close()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exc):
+    self.close()
@@ -1,186 +1,392 @@
 #!/usr/bin/python3
-from random import choices, randrange
-from datetime import datetime
+import random
+from bisect import bisect
+from dataclasses import dataclass
+import numpy as np
 from dateutil.relativedelta import relativedelta
-from datetime import timedelta
-from datetime import datetime, date
+from datetime import date
 
-# select region
-def select_region(demographics):
+# split an age range into its low and high values
+def split_age_range(age_range):
   """
-  Selects a region based on provided demographics
+  Splits an age range such as `20_24` into its low and high values
   Parameters:
-    demographics: a dataframe of demographics
+    age_range: a string containing an age range
   Returns:
-    region: a string containing selected region
+    a tuple containing the low and high age as strings
   """
-  # get a list of regions with their population totals
-  regions = demographics.groupby('Region').sum()
-  # calculate frequencies
-  regions['freq'] = regions['Population']/regions['Population'].sum()
-  # select region
-  region = choices(regions.index, regions['freq'], k=1)[0]
-  return region
+  age_low, age_high = age_range.split('_')
+  # check if that the age range is 85 and above
+  if age_high == '':
+    # if it is, change the high to 110 - a maximum age a person can be
+    age_high = '110'
+  return age_low, age_high
 
-# select area
-def select_area(demographics, region):
+# calculate the start date and end date from the date range
+def get_date_range(age_low, age_high, today=None):
   """
-  Selects an area based on provided demographics and region
+  Calculates the start date and end date based on given age range
   Parameters:
-    demographics: a dataframe of demographics
-    region: a string containing selected region
+    age_low: a string containing lowest age range
+    age_high: a string containing highest age range
+    today: the date ages are calculated at, the current date by default
   Returns:
-    area: a string containing selected area
+    a tuple containing start date and end date
   """
-  # get a list of areas within the regions with their populations
-  areas = demographics.loc[demographics['Region'] == region]
-  # sum different ethnicities by area
-  areas = areas.groupby('Area').sum()
-  # calculate freqiencies
-  areas['freq'] = areas['Population']/areas['Population'].sum()
-  # select an area
-  area = choices(areas.index, areas['freq'], k=1)[0]
-  return area
+  if today is None:
+    today = date.today()
+  end_date = today - relativedelta(years=int(age_low))
+  start_date = today - relativedelta(years=int(age_high))
+  return (start_date, end_date)
 
-# select ethnicity
-def select_ethnicity(demographics, region, area):
+ # a helper function for claculating age
+def calculate_age(dob, today=None):
   """
-  Selects an ethnicity based on provided demographics, region and area
+  Calculate current age based on dob
   Parameters:
-    demographics: a dataframe of demographics
-    region: a string containing selected region
-    area: a string containing selected area
+      dob: date of birht
+      today: the date ages are calculated at, the current date by default
   Returns:
-    ethnicity: a string containing selected ethnicity
+      age: an integer current age
   """
-  # create a dataframe with only specified region and area
-  ethnicities = demographics.loc[demographics['Region'] == region]
-  ethnicities = ethnicities.loc[ethnicities['Area'] == area]
-  # calculate freqiencies
-  ethnicities['freq'] = ethnicities['Population']/ethnicities['Population'].sum()
-  # select ethnicity
-  ethnicity = choices(list(ethnicities['Ethnicity']), list(ethnicities['freq']), k=1)[0]
-  return ethnicity
+  #dob = datetime.strptime(str(dob), "%d/%m/%Y")
+  if today is None:
+    today = date.today()
+  return today.year - dob.year - ((today.month, today.day) < (dob.month, dob.day))
+
+@dataclass
+class DemographicIndex:
+  """
+  Cumulative population tables compiled once from the demographics DataFrame.
+  Each level of the region -> area -> ethnicity hierarchy is stored as one
+  flat cumulative array, with `*_start` offsets marking the slice belonging to
+  each parent, so a draw is a binary search within that slice.
 
-# select gender
-def select_gender(demographics, region, area, ethnicity):
+  Attributes
+  ----------
+  regions: list of region names
+  region_cum: cumulative population by region
+  areas: list of area names, grouped by region
+  area_start: offsets into `areas` for each region (length regions + 1)
+  area_cum: cumulative population by area, running across all regions
+  ethnicities: list of ethnicities, one per demographics row, grouped by area
+  row_start: offsets into `ethnicities` for each area (length areas + 1)
+  row_cum: cumulative population by row, running across all areas
+  genders: list of gender names
+  gender_cum: cumulative gender weights for each row (rows x genders)
+  age_ranges: list of age ranges
+  age_cum: cumulative age range weights for each row (rows x age ranges)
+  reference_date: the date ages are calculated at, fixed for the whole run
+  dob_start: day ordinal of the earliest dob for each age range
+  dob_span: number of possible dobs for each age range
+  vocabularies: lists of distinct values by patient attribute, shared by every PatientBatch of the run
+  row_ethnicity: code of each row's ethnicity in vocabularies['ethnicity']
   """
-  Selects gender based on provided demographics, region, area and ethnicity
+
+  regions: list
+  region_cum: np.ndarray
+  areas: list
+  area_start: np.ndarray
+  area_cum: np.ndarray
+  ethnicities: list
+  row_start: np.ndarray
+  row_cum: np.ndarray
+  genders: list
+  gender_cum: np.ndarray
+  age_ranges: list
+  age_cum: np.ndarray
+  reference_date: date
+  dob_start: np.ndarray
+  dob_span: np.ndarray
+  vocabularies: dict
+  row_ethnicity: np.ndarray
+
+# calculate dob ranges as day ordinals
+def dob_ranges(age_ranges, reference_date):
+  """
+  Calculates the range of possible dobs for each age range
   Parameters:
-    demographics: a dataframe of demographics
-    region: a string containing selected region
-    area: a string containing selected area
-    ethnicity: a string containing selected ethnicity
+    age_ranges: a list of age ranges
+    reference_date: the date ages are calculated at
   Returns:
-    gender: a string containing selected gender
+    dob_start: day ordinal of the earliest dob for each age range
+    dob_span: number of possible dobs for each age range
   """
-  # create a dataframe with only specified region, area and ethnicity
-  gender = demographics.loc[demographics['Region'] == region]
-  gender = gender.loc[gender['Area'] == area]
-  gender = gender.loc[gender['Ethnicity']== ethnicity]
-  # transpose the dataframe
-  gender_t = gender[['Male','Female']].T
-  # select gender
-  gender = choices(list(gender_t.index), gender_t.values, k=1)[0]
-  return gender
+  bounds = [get_date_range(*split_age_range(age_range), reference_date) for age_range in age_ranges]
+  return np.array([start.toordinal() for start, _ in bounds]), \
+    np.array([(end - start).days for start, end in bounds])
 
-# select age
-def select_age(demographics, region, area, ethnicity):
+# compile the demographics into a sampling index
+def build_demographic_index(demographics, reference_date=None):
   """
-  Selects age based on provided demographics, region, area and ethnicity
+  Compiles the demographics DataFrame into cumulative probability tables
   Parameters:
     demographics: a dataframe of demographics
-    region: a string containing selected region
-    area: a string containing selected area
-    ethnicity: a string containing selected ethnicity
-    gender: a string containing selected gender
+    reference_date: the date ages are calculated at, the current date by default
+  Returns:
+    index: a DemographicIndex
+  """
+  # order rows so that every region, and every area within it, is contiguous
+  # regions and areas keep the order in which they first appear
+  data = demographics.reset_index(drop=True)
+  region_order = {r: i for i, r in enumerate(data['Region'].drop_duplicates())}
+  data = data.assign(_region=data['Region'].map(region_order))
+  data = data.sort_values('_region', kind='stable')
+  area_keys = list(zip(data['Region'], data['Area']))
+  area_order = {a: i for i, a in enumerate(dict.fromkeys(area_keys))}
+  data = data.assign(_area=[area_order[a] for a in area_keys])
+  data = data.sort_values('_area', kind='stable')
+
+  population = data['Population'].to_numpy(dtype=float)
+  regions = list(region_order)
+  areas = [area for _, area in area_order]
+
+  # region totals and area totals in the same order as the lists above
+  region_pop = np.bincount(data['_region'], weights=population, minlength=len(regions))
+  area_pop = np.bincount(data['_area'], weights=population, minlength=len(areas))
+  area_region = np.array([region_order[region] for region, _ in area_order])
+
+  # start offsets of each parent's slice in the flat child arrays
+  area_start = np.searchsorted(area_region, np.arange(len(regions) + 1))
+  row_start = np.searchsorted(data['_area'].to_numpy(), np.arange(len(areas) + 1))
+
+  # only keep the columns with age, as used by select_age
+  age_columns = data.columns[6:24]
+  genders = ['Male', 'Female']
+
+  # the range of dobs for each age range, as day ordinals
+  if reference_date is None:
+    reference_date = date.today()
+  dob_start, dob_span = dob_ranges(age_columns, reference_date)
+
+  # ethnicities repeat across areas, so rows are mapped to distinct codes
+  ethnicities = data['Ethnicity'].tolist()
+  ethnicity_order = {e: i for i, e in enumerate(dict.fromkeys(ethnicities))}
+
+  return DemographicIndex(
+    regions=regions,
+    region_cum=np.cumsum(region_pop),
+    areas=areas,
+    area_start=area_start,
+    area_cum=np.cumsum(area_pop),
+    ethnicities=ethnicities,
+    row_start=row_start,
+    row_cum=np.cumsum(population),
+    genders=genders,
+    gender_cum=np.cumsum(data[genders].to_numpy(dtype=float), axis=1),
+    age_ranges=age_columns.tolist(),
+    age_cum=np.cumsum(data[age_columns].to_numpy(dtype=float), axis=1),
+    reference_date=reference_date,
+    dob_start=dob_start,
+    dob_span=dob_span,
+    vocabularies={
+      'region': regions,
+      'area': areas,
+      'ethnicity': list(ethnicity_order),
+      'gender': genders,
+      'age_range': age_columns.tolist(),
+    },
+    row_ethnicity=np.array([ethnicity_order[e] for e in ethnicities]),
+  )
+
+# a helper function drawing from a slice of a flat cumulative array
+def draw_from_cum(cum, lo, hi, rng=random):
+  """
+  Selects an index in [lo, hi) with probability proportional to its weight
+  Parameters:
+    cum: a flat array of cumulative weights
+    lo: first index of the slice
+    hi: one past the last index of the slice
+    rng: source of uniform random numbers, the random module by default
+  Returns:
+    i: the selected index
+  """
+  base = cum[lo - 1] if lo > 0 else 0.0
+  target = base + rng.random() * (cum[hi - 1] - base)
+  return min(bisect(cum, target, lo, hi), hi - 1)
+
+# select all demographic values for a single patient
+def sample_demographics(index, rng=random):
+  """
+  Selects region, area, ethnicity, gender and age range from the compiled index
+  Parameters:
+    index: a DemographicIndex
+    rng: source of uniform random numbers, the random module by default
+  Returns:
+    a tuple containing region, area, ethnicity, gender and age range
+  """
+  r = draw_from_cum(index.region_cum, 0, len(index.regions), rng)
+  a = draw_from_cum(index.area_cum, index.area_start[r], index.area_start[r + 1], rng)
+  row = draw_from_cum(index.row_cum, index.row_start[a], index.row_start[a + 1], rng)
+  g = draw_from_cum(index.gender_cum[row], 0, len(index.genders), rng)
+  age = draw_from_cum(index.age_cum[row], 0, len(index.age_ranges), rng)
+  return index.regions[r], index.areas[a], index.ethnicities[row], \
+    index.genders[g], index.age_ranges[age]
+
+# generate a random dob for an age range
+def select_dob(index, age_range, rng=random):
+  """
+  Generates a random date of birth within an age range
+  Parameters:
+    index: a DemographicIndex
+    age_range: a string containing an age range
+    rng: source of random numbers, the random module by default
   Returns:
     dob: a randomly generated date of birth
-    age_range: a string containing selected age range
-  """
-  # create a dataframe with only specified region, area and ethnicity
-  age = demographics.loc[demographics['Region'] == region]
-  age = age.loc[age['Area'] == area]
-  age = age.loc[age['Ethnicity']== ethnicity]
-  # only keep the columns with age
-  age = age.iloc[:,6:24]
-  # transpose
-  age_t = age.T
-  # select a random age range
-  age_range = choices(list(age_t.index), age_t.values, k=1)[0]
-  # extract the low and high values
-  age_low, age_high = age_range.split('_')
-  # check if that the age range is 85 and above
-  if age_high == '':
-    # if it is, change the high to 110 - a maximum age a person can be
-    age_high = '110'
-  # get age range to select from
-  date_range = get_date_range(age_low, age_high)
-  # generate random dob
-  dob = generate_DOB(date_range[0], date_range[1])
-  return dob, age_range
+  """
+  i = index.age_ranges.index(age_range)
+  return date.fromordinal(int(index.dob_start[i]) + rng.randrange(int(index.dob_span[i])))
 
-# calculate the start date and end date from the date range
-def get_date_range(age_low, age_high):
+# a helper function drawing from slices of a flat cumulative array in bulk
+def draw_from_cum_batch(cum, lo, hi, u):
   """
-  Calculates the start date and end date based on given age range
+  Vectorised version of draw_from_cum, one draw per element of `lo`
   Parameters:
-    age_low: a string containing lowest age range
-    age_high: a string containing highest age range
+    cum: a flat array of cumulative weights
+    lo: an array of first indices of the slices
+    hi: an array of one past the last indices of the slices
+    u: an array of uniform random numbers in [0, 1)
   Returns:
-    a tuple containing start date and end date
+    an array of selected indices
   """
-  end_date = datetime.date(datetime.now() - relativedelta(years=int(age_low)))
-  start_date = datetime.date(datetime.now() - relativedelta(years=int(age_high)))
-  return (start_date, end_date)
+  base = np.where(lo > 0, cum[lo - 1], 0.0)
+  target = base + u * (cum[hi - 1] - base)
+  return np.minimum(np.searchsorted(cum, target, side='right'), hi - 1)
 
-# generate a random DOB based on start and end dates
-def generate_DOB(start_date, end_date):
+# a helper function drawing one column from each row of cumulative weights
+def draw_from_rows_batch(cum, u):
   """
-  Generates a random date of birth based on start date and end date
+  Selects a column for every row of a 2D array of cumulative weights
   Parameters:
-    start_date: earliest date
-    end_date: lastest date
+    cum: a 2D array of cumulative weights (draws x options)
+    u: an array of uniform random numbers in [0, 1)
   Returns:
-    dob: randomly generated dob
+    an array of selected column indices
   """
-  delta = end_date - start_date
-  int_delta = (delta.days * 24 * 60 * 60) + delta.seconds
-  random_second = randrange(int_delta)
-  return start_date + timedelta(seconds=random_second)
+  target = u * cum[:, -1]
+  return np.minimum((cum <= target[:, None]).sum(axis=1), cum.shape[1] - 1)
 
- # a helper function for claculating age
-def calculate_age(dob):
+# select demographic values for many patients at once
+def sample_demographics_batch(index, n, rng):
   """
-  Calculate current age based on dob
+  Selects region, area, demographics row, gender and age range for n patients
   Parameters:
-      dob: date of birht
+    index: a DemographicIndex
+    n: number of patients
+    rng: a numpy Generator
   Returns:
-      age: an integer current age
+    a tuple of integer arrays indexing into index.regions, index.areas,
+    index.ethnicities, index.genders and index.age_ranges
   """
-  #dob = datetime.strptime(str(dob), "%d/%m/%Y")
-  today = date.today()
-  return today.year - dob.year - ((today.month, today.day) < (dob.month, dob.day))
+  regions = np.minimum(np.searchsorted(index.region_cum, rng.random(n) * index.region_cum[-1], \
+                                       side='right'), len(index.regions) - 1)
+  areas = draw_from_cum_batch(index.area_cum, index.area_start[regions], \
+                              index.area_start[regions + 1], rng.random(n))
+  rows = draw_from_cum_batch(index.row_cum, index.row_start[areas], \
+                             index.row_start[areas + 1], rng.random(n))
+  genders = draw_from_rows_batch(index.gender_cum[rows], rng.random(n))
+  age_ranges = draw_from_rows_batch(index.age_cum[rows], rng.random(n))
+  return regions, areas, rows, genders, age_ranges
+
+# generate random dobs for many patients at once
+def generate_DOB_batch(index, codes, rng):
+  """
+  Generates random dates of birth for an array of age range indices
+  Parameters:
+    index: a DemographicIndex
+    codes: an array of indices into index.age_ranges
+    rng: a numpy Generator
+  Returns:
+    dob: an array of datetime64[D] dates of birth
+  """
+  # day ordinals are counted from 0001-01-01, datetime64 days from 1970-01-01
+  start = index.dob_start - date(1970, 1, 1).toordinal()
+  offset = rng.integers(index.dob_span[codes])
+  return (start[codes] + offset).astype('datetime64[D]')
+
+# calculate ages for many dobs at once
+def calculate_age_batch(dob, today=None):
+  """
+  Vectorised version of calculate_age
+  Parameters:
+    dob: an array of datetime64[D] dates of birth
+    today: the date ages are calculated at, the current date by default
+  Returns:
+    age: an integer array of current ages
+  """
+  if today is None:
+    today = date.today()
+  today = np.datetime64(today, 'D')
+  def year_month_day(d):
+    year = d.astype('datetime64[Y]').astype(np.int64)
+    month = d.astype('datetime64[M]').astype(np.int64) % 12
+    day = (d - d.astype('datetime64[M]')).astype(np.int64)
+    return year, month * 32 + day
+  today_year, today_md = year_month_day(today)
+  dob_year, dob_md = year_month_day(dob)
+  return today_year - dob_year - (today_md < dob_md)
 
-# match deprivation score to the generated area
-def match_deprivation(deprivation, area):
+# match deprivation scores to a list of areas
+def match_deprivation_areas(deprivation, areas):
   """
-  Match the area selected to the deprivation score
+  Match every area in a list to its deprivation score
   Parameters:
     deprivation: a dataframe of deprivation scored
+    areas: a list of area names
+  Returns:
+    an integer array of scores, one per area
+  """
+  scores = deprivation.drop_duplicates('area').set_index('area')['NZDep2018']
+  # areas not found use the average of all areas, rounded to nearest integer
+  fallback = round(deprivation['NZDep2018'].mean())
+  return scores.reindex(areas).fillna(fallback).to_numpy(dtype=np.int64)
+
+@dataclass
+class DeprivationIndex:
+  """
+  Deprivation scores compiled once from the deprivation DataFrame.
+
+  Attributes
+  ----------
+  scores: dict mapping an area name to its deprivation score
+  fallback: score used for areas without one, the rounded average of all areas
+  by_area: integer array of scores aligned with a DemographicIndex's areas
+  unmatched: list of demographic areas without a deprivation score
+  """
+
+  scores: dict
+  fallback: int
+  by_area: np.ndarray
+  unmatched: list
+
+# compile the deprivation scores into a lookup table
+def build_deprivation_index(deprivation, areas):
+  """
+  Compiles the deprivation DataFrame into a lookup table by area
+  Parameters:
+    deprivation: a dataframe of deprivation scored
+    areas: a list of area names, as in DemographicIndex.areas
+  Returns:
+    index: a DeprivationIndex
+  """
+  # the first score listed for an area is used
+  scores = deprivation.drop_duplicates('area')
+  scores = dict(zip(scores['area'], scores['NZDep2018'].tolist()))
+  return DeprivationIndex(
+    scores=scores,
+    fallback=round(deprivation['NZDep2018'].mean()),
+    by_area=match_deprivation_areas(deprivation, areas),
+    unmatched=[area for area in dict.fromkeys(areas) if area not in scores],
+  )
+
+# look up the deprivation score of an area
+def lookup_deprivation(index, area):
+  """
+  Match the area selected to the deprivation score, the average of all areas if it has none
+  Parameters:
+    index: a DeprivationIndex
     area: selected area
   Returns:
     deprivation_score: a score matched to the area
   """
-  # extract the score based on area name
-  score = deprivation.loc[deprivation['area'] == area]['NZDep2018']
-  # if location found
-  if len(score) != 0:
-    score = score.values[0]
-  # otherwise, use the average of all areas
-  else:
-    score = deprivation['NZDep2018'].mean()
-    # rounded to nearest integer
-    score = round(score)
-  return score
-
+  return index.scores.get(area, index.fallback)
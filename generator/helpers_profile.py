@@ -0,0 +1,91 @@
+#!/usr/bin/python3
+import json
+from time import perf_counter
+
+class Profiler:
+  """
+  Cumulative time and call counts by stage.
+  A disabled profiler skips the clock entirely, so instrumented code costs
+  a method call per stage when profiling is off.
+
+  Attributes
+  ----------
+  enabled: bool, whether to record anything
+  stages: dict mapping a stage name to a [seconds, calls] list
+  """
+
+  def __init__(self, enabled=True):
+    self.enabled = enabled
+    self.stages = {}
+
+  def start(self):
+    """
+    Returns the time a stage starts at, 0 when disabled
+    """
+    return perf_counter() if self.enabled else 0.0
+
+  def stop(self, stage, start):
+    """
+    Add the time since start to a stage
+    Parameters:
+      stage: stage name
+      start: value returned by start()
+    Returns:
+      None
+    """
+    if self.enabled:
+      totals = self.stages.setdefault(stage, [0.0, 0])
+      totals[0] += perf_counter() - start
+      totals[1] += 1
+
+  def count(self, stage, calls):
+    """
+    Add calls to a stage without timing them, e.g. cache hits
+    Parameters:
+      stage: stage name
+      calls: number of calls to add
+    Returns:
+      None
+    """
+    if self.enabled:
+      totals = self.stages.setdefault(stage, [0.0, 0])
+      totals[1] += calls
+
+  def merge(self, stages):
+    """
+    Add the totals of another profiler, e.g. one run in a worker
+    Parameters:
+      stages: the other profiler's stages
+    Returns:
+      None
+    """
+    for stage, (seconds, calls) in stages.items():
+      totals = self.stages.setdefault(stage, [0.0, 0])
+      totals[0] += seconds
+      totals[1] += calls
+
+  def summary(self):
+    """
+    Print the totals by stage, slowest first
+    """
+    total = sum(seconds for seconds, _ in self.stages.values()) or 1.0
+    print(f"===================================================================================================")
+    print(f"{'Stage':<40}{'Calls':>12}{'Seconds':>12}{'Mean (us)':>12}{'Share':>10}")
+    for stage, (seconds, calls) in sorted(self.stages.items(), key=lambda s: -s[1][0]):
+      print(f"{stage:<40}{calls:>12,}{seconds:>12.3f}{1e6 * seconds / max(calls, 1):>12.1f}{seconds / total:>10.1%}")
+    print(f"===================================================================================================")
+
+  def save(self, location):
+    """
+    Save the totals by stage as JSON
+    Parameters:
+      location: file location, incl file name
+    Returns:
+      None
+    """
+    with open(location, 'w') as f:
+      json.dump({stage: {'seconds': seconds, 'calls': calls} \
+                 for stage, (seconds, calls) in self.stages.items()}, f, indent=2)
+
+# a profiler that records nothing, used when profiling is off
+NO_PROFILER = Profiler(enabled=False)
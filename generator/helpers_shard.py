@@ -0,0 +1,266 @@
+#!/usr/bin/python3
+import hashlib
+import json
+import os
+
+from .helpers_arrow import import_pyarrow
+from .helpers_csv import create_csv, open_text, CSVWriter
+
+# name of the manifest written next to every shard's output files
+MANIFEST = 'manifest.json'
+
+# manifest entries every shard of a run must agree on
+RUN_KEYS = ('shards', 'population', 'chunk_size', 'engine', 'seed', 'format', 'compression', 'reference_date', \
+            'timeline_bands', 'modules', 'config_hash', 'input_hash')
+
+# a helper function parsing a shard option
+def parse_shard(value):
+  """
+  Parse a shard given as `i/N`, counting shards from 0
+  Parameters:
+    value: a string such as `0/4`
+  Returns:
+    a tuple of the shard index and number of shards
+  """
+  try:
+    index, shards = (int(part) for part in value.split('/'))
+  except ValueError:
+    raise ValueError(f"Shard {value} is not of the form i/N")
+  if shards < 1 or not 0 <= index < shards:
+    raise ValueError(f"Shard {value} is out of range, expected 0 <= i < N")
+  return index, shards
+
+# a helper function selecting a shard's chunks
+def shard_chunks(chunks, index, shards):
+  """
+  Select the contiguous run of chunks belonging to a shard. Chunks keep their
+  position in the whole run, so the shards together produce exactly the
+  patients of an unsharded run with the same seed and chunk size.
+  Parameters:
+    chunks: a list of chunk sizes for the whole run
+    index: shard index, from 0
+    shards: number of shards
+  Returns:
+    a list of (chunk index, chunk size) tuples
+  """
+  first = index * len(chunks) // shards
+  last = (index + 1) * len(chunks) // shards
+  return [(position, chunks[position]) for position in range(first, last)]
+
+# a helper function for the output directory of a shard
+def shard_directory(index, shards, directory='output'):
+  """
+  Directory a shard's output files and manifest are written to
+  Parameters:
+    index: shard index, from 0
+    shards: number of shards
+    directory: directory of the whole run
+  Returns:
+    a path
+  """
+  return os.path.join(directory, f"shard-{index}-of-{shards}")
+
+# a helper function hashing the config file
+def file_digest(location):
+  """
+  Hash the contents of a file
+  Parameters:
+    location: file location, incl file name
+  Returns:
+    a hex digest
+  """
+  digest = hashlib.sha256()
+  with open(location, 'rb') as f:
+    for block in iter(lambda: f.read(2**20), b''):
+      digest.update(block)
+  return digest.hexdigest()
+
+# save a shard's manifest
+def write_manifest(directory, manifest):
+  """
+  Save a manifest next to a shard's output files, replacing it atomically
+  Parameters:
+    directory: the shard's output directory
+    manifest: a dictionary of JSON types
+  Returns:
+    None
+  """
+  location = os.path.join(directory, MANIFEST)
+  with open(location + '.tmp', 'w') as f:
+    json.dump(manifest, f, indent=2)
+  os.replace(location + '.tmp', location)
+
+# load a shard's manifest
+def read_manifest(directory):
+  """
+  Load the manifest of a shard
+  Parameters:
+    directory: the shard's output directory
+  Returns:
+    a dictionary
+  """
+  with open(os.path.join(directory, MANIFEST)) as f:
+    return json.load(f)
+
+# check shards belong to the same run
+def validate_manifests(manifests):
+  """
+  Check a set of manifests are the complete shards of a single run
+  Parameters:
+    manifests: a list of manifest dictionaries
+  Returns:
+    the manifests, ordered by shard index
+  """
+  if not manifests:
+    raise ValueError("No shards to merge")
+  first = manifests[0]
+  for manifest in manifests[1:]:
+    for key in RUN_KEYS:
+      if manifest[key] != first[key]:
+        raise ValueError(f"Shards {first['shard']} and {manifest['shard']} differ in {key}: " \
+                         f"{first[key]} and {manifest[key]}")
+  indices = sorted(manifest['shard'] for manifest in manifests)
+  if indices != list(range(first['shards'])):
+    missing = sorted(set(range(first['shards'])) - set(indices))
+    raise ValueError(f"Expected shards 0 to {first['shards'] - 1} once each, " \
+                     f"missing {missing or 'none'}, found {indices}")
+  for manifest in manifests:
+    if sorted(manifest['files']) != sorted(first['files']):
+      raise ValueError(f"Shards {first['shard']} and {manifest['shard']} differ in files: " \
+                       f"{', '.join(sorted(first['files']))} and {', '.join(sorted(manifest['files']))}")
+    if not manifest.get('complete'):
+      raise ValueError(f"Shard {manifest['shard']} did not finish")
+  return sorted(manifests, key=lambda manifest: manifest['shard'])
+
+# a helper function concatenating csv files
+def merge_csv(sources, location, rows, compression='none'):
+  """
+  Concatenate csv files with the same header, checking their row counts
+  Parameters:
+    sources: a list of file locations, in order
+    location: file location of the merged file, incl file name
+    rows: expected number of data rows of each source
+    compression: one of `none`, `gzip` or `zstd`, for both the sources and the merged file
+  Returns:
+    None
+  """
+  merged = None
+  try:
+    for source, expected in zip(sources, rows):
+      with open_text(source, compression) as f:
+        header = f.readline()
+        if merged is None:
+          create_csv(location, header.rstrip('\n'), compression)
+          merged = CSVWriter(location, compression=compression)
+        # count rows while copying, in blocks rather than lines
+        count = 0
+        for block in iter(lambda: f.read(2**20), ''):
+          count += block.count('\n')
+          merged.file.write(block)
+      if count != expected:
+        raise ValueError(f"{source} has {count} rows, its manifest lists {expected}")
+  finally:
+    if merged is not None:
+      merged.close()
+
+# a helper function concatenating JSON lines files
+def merge_lines(sources, location, rows):
+  """
+  Concatenate JSON lines files, such as traces, checking their line counts
+  Parameters:
+    sources: a list of file locations, in order
+    location: file location of the merged file, incl file name
+    rows: expected number of lines of each source
+  Returns:
+    None
+  """
+  with open(location, 'w') as merged:
+    for source, expected in zip(sources, rows):
+      count = 0
+      with open(source) as f:
+        for block in iter(lambda: f.read(2**20), ''):
+          count += block.count('\n')
+          merged.write(block)
+      if count != expected:
+        raise ValueError(f"{source} has {count} lines, its manifest lists {expected}")
+
+# a helper function concatenating Parquet or Arrow files
+def merge_arrow(sources, location, rows, output_format, compression='none'):
+  """
+  Concatenate Parquet or Arrow IPC files with the same schema, batch by batch,
+  checking their row counts
+  Parameters:
+    sources: a list of file locations, in order
+    location: file location of the merged file, incl file name
+    rows: expected number of rows of each source
+    output_format: either `parquet` or `arrow`
+    compression: one of `none`, `gzip` or `zstd`, as the shards were written with
+  Returns:
+    None
+  """
+  pa = import_pyarrow()
+  if output_format == 'parquet':
+    import pyarrow.parquet as pq
+    files = [pq.ParquetFile(source) for source in sources]
+    codec = {} if compression == 'none' else {'compression': compression}
+    writer = pq.ParquetWriter(location, files[0].schema_arrow, **codec)
+  else:
+    files = [pa.ipc.open_file(source) for source in sources]
+    options = pa.ipc.IpcWriteOptions(compression=None if compression == 'none' else compression)
+    writer = pa.ipc.new_file(location, files[0].schema, options=options)
+
+  # one row group or record batch at a time, so whole shards are never held in memory
+  def tables(file):
+    if output_format == 'parquet':
+      for i in range(file.num_row_groups):
+        yield file.read_row_group(i)
+    else:
+      for i in range(file.num_record_batches):
+        yield pa.Table.from_batches([file.get_batch(i)])
+
+  with writer:
+    for source, expected, file in zip(sources, rows, files):
+      count = 0
+      for table in tables(file):
+        count += table.num_rows
+        writer.write_table(table)
+      if count != expected:
+        raise ValueError(f"{source} has {count} rows, its manifest lists {expected}")
+
+# merge the shards of a run
+def merge_shards(directories, output='output'):
+  """
+  Validate the manifests of a run's shards and concatenate their output files,
+  and traces if they were recorded, in shard order, giving the output of an unsharded run with the same seed
+  Parameters:
+    directories: the shards' output directories
+    output: directory to write the merged files and manifest to
+  Returns:
+    manifest: the merged manifest
+  """
+  manifests = validate_manifests([dict(read_manifest(directory), directory=directory) \
+                                  for directory in directories])
+  first = manifests[0]
+  os.makedirs(output, exist_ok=True)
+
+  files = {}
+  for name in first['files']:
+    sources = [os.path.join(manifest['directory'], manifest['files'][name]) for manifest in manifests]
+    rows = [manifest['rows'][name] for manifest in manifests]
+    location = os.path.join(output, first['files'][name])
+    if name == 'trace':
+      merge_lines(sources, location, rows)
+    elif first['format'] == 'csv':
+      merge_csv(sources, location, rows, first['compression'])
+    else:
+      merge_arrow(sources, location, rows, first['format'], first['compression'])
+    files[name] = first['files'][name]
+
+  manifest = {key: first[key] for key in RUN_KEYS}
+  manifest.update(
+    files=files,
+    rows={name: sum(m['rows'][name] for m in manifests) for name in files},
+    merged=[{'shard': m['shard'], 'directory': m['directory'], 'rows': m['rows']} for m in manifests],
+  )
+  write_manifest(output, manifest)
+  return manifest
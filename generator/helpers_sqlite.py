@@ -0,0 +1,175 @@
+#!/usr/bin/python3
+import os
+import sqlite3
+from datetime import date
+
+# dates are stored as ISO 8601 text, registered explicitly as the default adapters are deprecated
+sqlite3.register_adapter(date, date.isoformat)
+
+# prefix of the --output value selecting a SQLite database
+SQLITE_PREFIX = 'sqlite:'
+
+# a helper function parsing an output option
+def parse_output(value):
+  """
+  Parse an output given as `sqlite:path.db`
+  Parameters:
+    value: the option's value
+  Returns:
+    the database location
+  """
+  if not value.startswith(SQLITE_PREFIX) or not value[len(SQLITE_PREFIX):]:
+    raise ValueError(f"Output {value} is not of the form {SQLITE_PREFIX}path.db")
+  return value[len(SQLITE_PREFIX):]
+
+# a helper function quoting an identifier, e.g. a module name used as a column
+def quote(name):
+  """
+  Quote a table, column or index name for SQL
+  Parameters:
+    name: the name
+  Returns:
+    the quoted name
+  """
+  return '"' + name.replace('"', '""') + '"'
+
+class SQLiteDatabase:
+  """
+  A SQLite database bulk loaded by one SQLiteWriter per table.
+  The database is created from scratch, with journaling and syncing turned
+  off while loading, as a run killed part way leaves nothing worth keeping.
+  Indexes are only built once every writer is closed, which is much faster
+  than keeping them up to date row by row.
+
+  Attributes
+  ----------
+  location: file location, incl file name
+  connection: the open sqlite3 connection, shared by every writer
+  indexes: a list of (table, column, unique) tuples to index after loading
+  writers: number of writers not yet closed
+  """
+
+  def __init__(self, location, tables, indexes=()):
+    """
+    Create the database and its tables
+    Parameters:
+      location: file location, incl file name
+      tables: a dictionary of lists of (column, type) tuples by table name
+      indexes: a list of (table, column, unique) tuples to index after loading
+    """
+    self.location = location
+    self.indexes = list(indexes)
+    self.writers = 0
+    if os.path.exists(location):
+      os.remove(location)
+    # rows may be written from the background writer thread, one thread at a time
+    self.connection = sqlite3.connect(location, isolation_level=None, check_same_thread=False)
+    self.connection.execute('PRAGMA journal_mode = OFF')
+    self.connection.execute('PRAGMA synchronous = OFF')
+    self.connection.execute('PRAGMA temp_store = MEMORY')
+    self.connection.execute('PRAGMA cache_size = -65536')
+    for table, columns in tables.items():
+      self.connection.execute(f"CREATE TABLE {quote(table)} " \
+                              f"({', '.join(f'{quote(column)} {kind}' for column, kind in columns)})")
+
+  def writer(self, table, columns, buffer_size=10000):
+    """
+    A writer inserting rows into one of the tables
+    """
+    self.writers += 1
+    return SQLiteWriter(self, table, columns, buffer_size)
+
+  def insert(self, table, columns, rows):
+    """
+    Insert rows in a single transaction
+    Parameters:
+      table: table name
+      columns: list of column names, in the order of the rows
+      rows: a list of rows
+    Returns:
+      None
+    """
+    statement = f"INSERT INTO {quote(table)} ({', '.join(map(quote, columns))}) " \
+                f"VALUES ({', '.join('?' * len(columns))})"
+    self.connection.execute('BEGIN')
+    self.connection.executemany(statement, rows)
+    self.connection.execute('COMMIT')
+
+  def release(self):
+    """
+    Called by each writer when closed, the last one builds the indexes and closes the database
+    """
+    self.writers -= 1
+    if self.writers > 0:
+      return
+    for table, column, unique in self.indexes:
+      self.connection.execute(f"CREATE {'UNIQUE ' if unique else ''}INDEX {quote(f'{table}_{column}')} " \
+                              f"ON {quote(table)} ({quote(column)})")
+    self.connection.execute('ANALYZE')
+    self.connection.close()
+
+class SQLiteWriter:
+  """
+  A buffered writer inserting rows into one table of a SQLiteDatabase.
+  Rows are collected in memory and inserted with executemany in one
+  transaction every `buffer_size` rows.
+
+  Attributes
+  ----------
+  database: the SQLiteDatabase
+  table: table name
+  columns: list of column names, in the order of the rows
+  buffer_size: number of rows to collect before inserting them
+  location: the database's file location
+  """
+
+  def __init__(self, database, table, columns, buffer_size=10000):
+    self.database = database
+    self.table = table
+    self.columns = columns
+    self.buffer_size = buffer_size
+    self.location = database.location
+    self.buffer = []
+
+  def write(self, rows):
+    """
+    Add rows to the buffer, inserting them when full
+    Parameters:
+      rows: an iterable of rows
+    Returns:
+      None
+    """
+    self.buffer.extend(rows)
+    if len(self.buffer) >= self.buffer_size:
+      self.flush()
+
+  def write_columns(self, columns):
+    """
+    Add a chunk held as columns, decoded to rows as sqlite3 inserts rows
+    Parameters:
+      columns: a Columns chunk
+    Returns:
+      None
+    """
+    self.write(columns.rows())
+
+  def flush(self):
+    """
+    Insert all buffered rows
+    """
+    if self.buffer:
+      self.database.insert(self.table, self.columns, self.buffer)
+    self.buffer = []
+
+  def close(self):
+    """
+    Insert remaining rows and release the database
+    """
+    self.flush()
+    self.database.release()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exc):
+    self.close()
@@ -1,262 +1,599 @@
 #!/usr/bin/python3
-from random import choices
+from dataclasses import dataclass, field
+import random
+import threading
+from bisect import bisect
+from collections import OrderedDict
+import numpy as np
 
-# a helper function for setting initial probabilities for each module
-def set_initial_prob(module, data, patient, prob):
+from .helpers_patient import draw_from_rows_batch
+from .helpers_trace import NO_TRACER
+
+@dataclass
+class CharRule:
     """
-    Set initial probabilities for each module
-    Including recalculating them based on static characteristics
+    A static or dynamic characteristic parsed from a module's input data.
+
+    Attributes
+    ----------
+    variable: str, patient or timeline key the rule refers to
+    value: str, value as written in the input data, e.g. `Male` or `>6`
+    operator: str, one of `>`, `<` or `=`
+    threshold: int, the number compared against for `>` and `<`, otherwise None
+    mult: np.ndarray, values to multiply each state's probability by
+    """
+
+    variable: str
+    value: str
+    operator: str
+    threshold: int
+    mult: np.ndarray
+
+@dataclass
+class CompiledModule:
+    """
+    A module's input data compiled into arrays once at load time.
+
+    Attributes
+    ----------
+    name: str
+    states: list of possible states
+    initial_prob: dict mapping an age range to its prior initial probabilities
+    trans_prob: np.ndarray, prior state transition probabilities (states x states)
+    static_char: list of CharRule applied from patient information
+    dynamic_char: list of CharRule applied from the timelines
+    """
+
+    name: str
+    states: list
+    initial_prob: dict
+    trans_prob: np.ndarray
+    static_char: list
+    dynamic_char: list
+
+# a helper function for parsing characteristic rows into rules
+def compile_char(rows, states):
+    """
+    Parse static or dynamic characteristic rows
+    Parameters:
+        rows: a dataframe of characteristic rows
+        states: a list of possible states
+    Returns:
+        a list of CharRule
+    """
+    rules = []
+    for variable, value, mult in zip(rows['variable'], rows['value'], rows[states].to_numpy(dtype=float)):
+        value = str(value)
+        # check if it refers to greater than or less than, otherwise assume equals
+        if value[0] in ('>', '<'):
+            rules.append(CharRule(variable, value, value[0], int(value[1:]), mult))
+        else:
+            rules.append(CharRule(variable, value, '=', None, mult))
+    return rules
+
+# a helper function compiling module input data
+def compile_module(module, data):
+    """
+    Compile a module's input data into arrays and parsed rules
     Parameters:
         module: module name
         data: a dataframe of input settings
-        patient: a dictionary of patient object
-        prob: boolean, whether to show probability information
     Returns:
-        states: a list of possible states
-        posterior_trans_prob: posterior state transition probabilities
+        a CompiledModule
     """
     # set states
     states = data.iloc[:,3:-1].columns.tolist()
-    # extract the prior transition probabilities
+
+    # prior initial probabilities keyed by age range, first row wins
+    prior_initial_prob = data.loc[data['type'] == 'PriorInitialProb'].drop_duplicates('value')
+    initial_prob = dict(zip(prior_initial_prob['value'], prior_initial_prob[states].to_numpy(dtype=float)))
+
+    # one prior transition row per state, in state order
     prior_trans_prob = data.loc[data['type'] == 'PriorTransProb']
-    # and static characteristics
-    static_char = data.loc[data['type'] == 'StaticChar']
-    # set posterior transition probabilities
-    posterior_trans_prob = []
-    # iterate over a number of states
-    for i in range(len(states)):
-      posterior_trans_prob.append(prior_trans_prob.iloc[i,3:-1].values.tolist())
-
-    if prob:
-      print()
-      print(f"Module: {module}")
-      print(f"Possible states: {states}")
-      print(f"Prior state transition probabilities: "+str([[f"{x:.3f}" for x in y] for y in posterior_trans_prob]))
+    if len(prior_trans_prob) < len(states):
+        raise ValueError(f"Module {module} has {len(prior_trans_prob)} PriorTransProb rows for {len(states)} states")
+    trans_prob = prior_trans_prob[states].to_numpy(dtype=float)[:len(states)]
 
-    ## amend prior transition probabilities based on static characteristics
-    for row in static_char.itertuples():
-      multiplications, changed = amend_prob_char(row, patient, prob)
-      if changed:
-        posterior_trans_prob = amend_prob(posterior_trans_prob, [multiplications]*len(states))
-        if prob:
-          print(f"- Posterior state transition probabilities: "+str([[f"{x:.3f}" for x in y] for y in posterior_trans_prob]))
+    static_char = compile_char(data.loc[data['type'] == 'StaticChar'], states)
+    dynamic_char = compile_char(data.loc[data['type'] == 'DynamicChar'], states)
+
+    return CompiledModule(module, states, initial_prob, trans_prob, static_char, dynamic_char)
+
+@dataclass
+class TransitionState:
+    """
+    A patient's posterior state transitions for one module.
+    As every multiplier scales all rows of the transition matrix alike, the
+    posterior matrix is the prior one with each column scaled by the product of
+    all multipliers applied so far. Only that product is kept, and the
+    cumulative row used for sampling is recomputed, for the current state
+    only, when it changes.
 
-    return states, posterior_trans_prob
+    Attributes
+    ----------
+    trans_prob: np.ndarray, the module's prior transition probabilities, shared
+    static_mult: np.ndarray, product of static characteristic multipliers
+    mult: np.ndarray, product of all multipliers applied to the transitions
+    cum: list of cumulative, unnormalised posterior rows by state, each None until sampled from, None since the last amend
+    state: int, index of the current state, None before the first one
+    profile: StaticProfile shared with patients of the same static profile, None when not cached
+    """
+
+    trans_prob: np.ndarray
+    static_mult: np.ndarray
+    mult: np.ndarray
+    cum: list = None
+    state: int = None
+    profile: "StaticProfile" = None
+
+    def amend(self, mult):
+        """
+        Multiply the posterior transitions in place
+        """
+        self.mult *= mult
+        self.cum = None
+
+    def posterior(self):
+        """
+        Normalised posterior transition probabilities
+        """
+        rows = self.trans_prob * self.mult
+        return rows / rows.sum(axis=1, keepdims=True)
+
+    def transition(self, rng):
+        """
+        Select the next state from the current one
+        """
+        if self.cum is None:
+            self.cum = [None] * len(self.trans_prob)
+        row = self.cum[self.state]
+        if row is None:
+            # a row of the whole matrix's cumulative sum, without building the other rows
+            row = self.cum[self.state] = np.cumsum(self.trans_prob[self.state] * self.mult).tolist()
+        self.state = draw_state(row, rng)
+        return self.state
+
+@dataclass
+class StaticProfile:
+    """
+    Everything a module derives from its static characteristics, for one
+    combination of the patient values they refer to. Shared read-only by every
+    patient with that combination, so its lists must never be modified.
+
+    Attributes
+    ----------
+    static_mult: np.ndarray, product of static characteristic multipliers
+    trans_cum: list of cumulative, unnormalised posterior transition rows
+    initial_cum: dict mapping an age range to its cumulative, unnormalised initial row
+    """
+
+    static_mult: np.ndarray
+    trans_cum: list
+    initial_cum: dict = field(default_factory=dict)
+
+class PosteriorCache:
+    """
+    A bounded LRU cache of StaticProfile keyed by module and the values of the
+    patient attributes its static characteristics refer to. Patients share a
+    few hundred profiles, so after warm-up almost every lookup is a hit.
+
+    Attributes
+    ----------
+    maxsize: int, number of profiles kept, least recently used ones are dropped first
+    profiles: OrderedDict of StaticProfile by key, least recently used first
+    lock: guards profiles and their initial rows, as threads of the thread backend share one cache
+    local: per-thread [hits, misses] by lookup, `transitions` or `initial`, so each chunk counts only its own
+    """
 
-# a helper function for selecting next state from a list of states with probabilities
-def mcmc(states, probabilities, initial_state):
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self.profiles = OrderedDict()
+        self.lock = threading.Lock()
+        self.local = threading.local()
+
+    def count(self, lookup, hit):
+        """
+        Count a lookup made by the calling thread
+        """
+        counts = self.local.__dict__.setdefault('counts', {'transitions': [0, 0], 'initial': [0, 0]})
+        counts[lookup][0 if hit else 1] += 1
+
+    def profile(self, module, data, patient):
+        """
+        The StaticProfile of a patient for a module, calculated on a miss
+        """
+        variables = static_variables(data)
+        key = (module,) + tuple(patient[v] if v in patient else None for v in variables)
+        with self.lock:
+            profile = self.profiles.get(key)
+            if profile is not None:
+                self.profiles.move_to_end(key)
+        if profile is not None:
+            self.count('transitions', True)
+            return profile
+        self.count('transitions', False)
+
+        static_mult = np.ones(len(data.states))
+        for row in data.static_char:
+            if char_applies(row, patient):
+                static_mult *= row.mult
+        profile = StaticProfile(static_mult, np.cumsum(data.trans_prob * static_mult, axis=1).tolist())
+
+        with self.lock:
+            self.profiles[key] = profile
+            if len(self.profiles) > self.maxsize:
+                self.profiles.popitem(last=False)
+        return profile
+
+    def initial(self, profile, data, age_range):
+        """
+        Cumulative initial probabilities of an age range, amended by the profile's static characteristics
+        """
+        with self.lock:
+            cum = profile.initial_cum.get(age_range)
+        if cum is not None:
+            self.count('initial', True)
+            return cum
+        self.count('initial', False)
+        cum = np.cumsum(data.initial_prob[age_range] * profile.static_mult).tolist()
+        # another thread may have added the row meanwhile, keep the first one
+        with self.lock:
+            return profile.initial_cum.setdefault(age_range, cum)
+
+    def take_counts(self):
+        """
+        Hits and misses of the calling thread since it last took them,
+        as a dictionary of [hits, misses] by lookup, starting again from 0
+        """
+        return self.local.__dict__.pop('counts', None) or {'transitions': [0, 0], 'initial': [0, 0]}
+
+# a helper function listing the patient attributes a module's static characteristics refer to
+def static_variables(data):
   """
-  Returns the next state given an initial state
+  List the distinct variables of a module's static characteristics
   Parameters:
-    states: a list of possble states
-    probabilities: a matrix of probabilities of each state turning into another
-    initial_state: a string containing one of the possible states
+    data: a CompiledModule
   Returns:
-    next_state: next_state calculated based on probabilities
+    a tuple of variable names, in the order they first appear
   """
-  # first, generate a list of possible transitions
-  transitions = []
-  # iterate through the transitions twice
-  for state1 in states:
-    state_transitions = []
-    for state2 in states:
-      state_transitions.append((state1, state2)) 
-      transitions.append(state_transitions)
-  # set up an empty return value
-  next_state = ''
-  # based on given probabilities, choose the next state
-  for i in range(len(states)):
-      if initial_state == states[i]:
-        change = choices(transitions[i], probabilities[i], k=1)[0]
-        for j in range(len(states)):
-          if change == transitions[i][j]:
-            next_state = states[i]
-          if change == transitions[i][j]:
-            next_state = states[j]
-          if change == transitions[i][j]:
-            next_state = states[j]
-  return next_state
-
-# a fuction to amend probabilities based on multiplication values
-def amend_prob(probabilities, amendments):
+  return tuple(dict.fromkeys(row.variable for row in data.static_char))
+
+# a helper function selecting an index from cumulative weights
+def draw_state(cum, rng=random):
   """
-  Amend probabilities based on provided values
+  Select an index with probability proportional to its weight,
+  drawing exactly as random.choices does with cumulative weights
   Parameters:
-    probabilities: a list of list of probabilities for transitions
-    amendments: a list of lists of values to multiply the probabilities by
+    cum: a list of cumulative weights
+    rng: source of random numbers, the random module by default
   Returns:
-    normalised list of lists of probabilities
+    the selected index
   """
-  for i in range(len(probabilities)):
-    probabilities[i] = [a*b for a,b in zip(probabilities[i], amendments[i])]
-    # normalise
-    probabilities[i] = [float(j)/sum(probabilities[i]) for j in probabilities[i]]
-  return probabilities
-
-# a function to check for relevant
-def check_char_equality(char, data, prob):
+  return bisect(cum, rng.random() * cum[-1], 0, len(cum) - 1)
+
+# a helper function for setting initial probabilities for each module
+def set_initial_prob(module, data, patient, trace=NO_TRACER, cache=None):
+    """
+    Set initial probabilities for each module
+    Including recalculating them based on static characteristics
+    Parameters:
+        module: module name
+        data: a CompiledModule
+        patient: a dictionary of patient object
+        trace: a Tracer recording probability details, off by default
+        cache: a PosteriorCache to share the results between patients with the same static profile, None to calculate them
+    Returns:
+        transitions: a TransitionState with posterior state transition probabilities
+    """
+    # traced patients list every characteristic applied, so are never cached
+    if cache is not None and not trace:
+      profile = cache.profile(module, data, patient)
+      return TransitionState(data.trans_prob, profile.static_mult, profile.static_mult.copy(), \
+                             profile.trans_cum, profile=profile)
+
+    static_mult = np.ones(len(data.states))
+
+    ## amend prior transition probabilities based on static characteristics
+    applied = []
+    for row in data.static_char:
+      if char_applies(row, patient):
+        static_mult *= row.mult
+        if trace:
+          applied.append(trace_char(row))
+
+    transitions = TransitionState(data.trans_prob, static_mult, static_mult.copy())
+    if trace:
+      trace.emit('set_initial_prob', module=module, states=data.states, prior=data.trans_prob.tolist(), \
+                 applied=applied, posterior=transitions.posterior().tolist())
+
+    return transitions
+
+# a function comparing a single value against a characteristic
+def char_matches(char, value):
   """
-  A function to check if the characteristics is equal, greater than or less than
+  Check whether a value is greater than, less than or equal to the characteristic
   Parameters:
-    char: details of the characteristic
-    data: either patient data, current timeline or previous tmeline
+    char: a CharRule
+    value: the patient or timeline value to compare
   Returns:
-    changed: a boolean value of whether the mutliplications have been changed
-    mult: multiplication values to use
+    a boolean value of whether the characteristic applies
   """
-  # get the number of possible states
-  no_states = len(char[4:-1])
-  # by default, set multiplicaton to to a list of 1s
-  mult = [1 for i in range(no_states)]
-  # set changed to False by default
-  changed = False
-
-  # check if it refers to greater than
-  if char[3][0] == '>':
-    if int(data[char[2]]) > int(char[3][1:]):
-      # get multiplication values
-      mult = char[4:-1]
-      changed = True
-      print_multiplications(char[2],char[3], mult, prob)
-  # or less than
-  elif char[3][0] == '<':
-    if int(data[char[2]]) < int(char[3][1:]):
-      mult = char[4:-1]
-      changed = True
-      print_multiplications(char[2],char[3], mult, prob)
-  # otherwise assume equals
-  else:
-    if data[char[2]] == char[3]:
-      mult= char[4:-1]
-      changed = True
-      print_multiplications(char[2],char[3], mult, prob)
+  if char.operator == '>':
+    return int(value) > char.threshold
+  if char.operator == '<':
+    return int(value) < char.threshold
+  return value == char.value
 
-  return changed, mult
-
-# a function to multiply probabilities based on characteristics
-def amend_prob_char(char, current_data, prob, previous_data = {}):
+# a function checking whether a characteristic applies
+def char_applies(char, current_data, previous_data=None):
   """
-  A function to iterate over given characteristics and extract relevant
-  multiplications.
+  Check a characteristic against current data, or previous data if it is not
+  present there, which allows for circular dependencies between modules
   Parameters:
-    char: a row of a dataframe containing characteristics
+    char: a CharRule
     current_data: a dictionary containing patient or timeline information
-    prob: boolean, whether to show probability information
-    previous_data: a dictionary containing previous timeline, by default an empty dict
+    previous_data: a dictionary containing previous timeline, None by default
   Returns:
-    mult: either list of 1s or multiplication to multiply probabilities by
-    changed: a boolean value of whether the mutliplications have been changed
+    a boolean value of whether the characteristic applies
   """
-  # get the number of possible states
-  no_states = len(char[4:-1])
-  # by default, set multiplicaton to to a list of 1s
-  mult = [1 for i in range(no_states)]
-  # set changed to False by default
-  changed = False
-
-  # check for current data
-  if char[2] in set(current_data.keys()):
-    # get multiplication if relevant
-    changed, mult = check_char_equality(char, current_data, prob)
-
-  # check if that characteristic is present in previous timeline
-  # this allows for circular dependencies to take effect
-  elif (previous_data != None) & (char[2] in set(previous_data.keys())):
-    # get multiplication if relevant
-    changed, mult = check_char_equality(char, previous_data, prob)
-
-  return mult, changed
-
-# a helper for printing probability information
-def print_multiplications(variable, value, mult, prob):
+  if char.variable in current_data:
+    return char_matches(char, current_data[char.variable])
+  if previous_data is not None and char.variable in previous_data:
+    return char_matches(char, previous_data[char.variable])
+  return False
+
+# a helper describing an applied characteristic in a trace
+def trace_char(char):
   """
-  A function to print probability information when relevant
-  Paramteres:
-    variable: variable name
-    value: variable's value
-    multiplication: mutliplication values to use
-    prob: boolean, whether to show probability information
+  Describe an applied characteristic for a trace event
+  Parameters:
+    char: a CharRule
   Returns:
-    None
+    a dictionary of the variable, value and multipliers
   """
-  if prob:
-    print(f"- Relevant variable: {variable}; value: {value}")
-    print(f"- Prior probabilities need multiplying by: {mult}")
+  return {'variable': char.variable, 'value': char.value, 'mult': char.mult.tolist()}
 
 # module runner
-def run_module(module, data, age_range, patient, current_timeline, previous_timeline, module_dict, prob):
+def run_module(module, data, age_range, patient, current_timeline, previous_timeline, module_dict, \
+               trace=NO_TRACER, rng=random, cache=None):
   """
   A function to generate a record for current age range.
   Parameters:
     module: module name
-    data: input data for that module
+    data: a CompiledModule for that module
     age_range: current age range
     patient: a dictionary of patient information
     current_timeline: a dictionary of current timeline so far
     previous_timeline: a dictionary of previours timeline
-    module_dict: a dictionary of states and probabilities for modules
-    prob: boolean, whether to show probability information
+    module_dict: a dictionary of TransitionState by module name
+    trace: a Tracer recording probability details, off by default
+    rng: source of random numbers, the random module by default
+    cache: the PosteriorCache used by set_initial_prob, None to calculate initial probabilities
   Returns:
     state: selected state
     module_dict: an updated dictionary of modules
   """
-  # get the patients id
-  id = patient['id']
-
-  # extract states, t and m probabilities from the module dict
-  states = module_dict[module][0]
-  posterior_trans_prob = module_dict[module][1]
-
-  # extract the demographic details
-  prior_initial_prob = data.loc[data['type'] == 'PriorInitialProb']
-  static_char = data.loc[data['type'] == 'StaticChar']
-  dynamic_char = data.loc[data['type'] == 'DynamicChar']
-
-  if prob:
-    print(f"---------------------")
-    print(f"Module: {module}")
-    print(f"---------------------")
+  transitions = module_dict[module]
 
   # if age range is included in the initial set up
-  if age_range in set(prior_initial_prob['value'].values):
-    ## initial set up
-    # get the relevant prior initial probabilities
-    probabilities = prior_initial_prob.loc[prior_initial_prob['value'] == age_range][states].values
-    if prob:
-      print(f"- Initial probabilities: {probabilities}")
-    ## amend initial setup based on static characteristics
-    for row in static_char.itertuples():
-      mult, changed = amend_prob_char(row, patient, prob)
-      if changed:
-        probabilities = amend_prob(probabilities, [mult])
-        if prob:
-          print(f"- Posterior probabilities: "+str([[f"{x:.3f}" for x in y] for y in probabilities]))
-
+  if age_range in data.initial_prob:
+    ## initial set up, amended based on static characteristics
+    if cache is not None and transitions.profile is not None:
+      cum = cache.initial(transitions.profile, data, age_range)
+    else:
+      cum = np.cumsum(data.initial_prob[age_range] * transitions.static_mult).tolist()
     # choose the state
-    module_state = choices(states, probabilities[0], k=1)[0]
-    if prob:
-      print(f"== Selected state: {module_state} ==")
+    transitions.state = draw_state(cum, rng)
+    module_state = data.states[transitions.state]
+    if trace:
+      trace.emit('initial', module=module, age_range=age_range, prior=data.initial_prob[age_range].tolist(), \
+                 posterior=(np.diff(cum, prepend=0) / cum[-1]).tolist(), state=module_state)
 
   ## transitions
   # if age_range is not included in the set up
-  if age_range not in set(prior_initial_prob['value'].values):
-    if prob:
-      print(f"- Prior state transition probabilities: "+str([[f"{x:.3f}" for x in y] for y in posterior_trans_prob]))
+  else:
+    if trace:
+      previous_state = '' if transitions.state is None else data.states[transitions.state]
+      prior = transitions.posterior().tolist()
+      applied = []
     # amend transitions based on dynamic characteristics
-    for row in dynamic_char.itertuples():
-      mult, changed = amend_prob_char(row, current_timeline, prob, previous_timeline)
-      if changed:
-        posterior_trans_prob = amend_prob(posterior_trans_prob, [mult]*len(states))
-        if prob:
-          print(f"- Posterior state transition probabilities: "+str([[f"{x:.3f}" for x in y] for y in posterior_trans_prob]))
-
-    # choose the next state
-    module_state = mcmc(states, posterior_trans_prob, module_dict[module][2])
-    if prob:
-      print(f"== Selected state: {module_state} ==")
-  
-  # update the module dictionary with new t probabilities
-  module_dict[module] = (states, posterior_trans_prob, module_state)
+    for row in data.dynamic_char:
+      if char_applies(row, current_timeline, previous_timeline):
+        transitions.amend(row.mult)
+        if trace:
+          applied.append(trace_char(row))
+
+    # choose the next state, there is none without a previous one
+    if transitions.state is None:
+      module_state = ''
+    else:
+      module_state = data.states[transitions.transition(rng)]
+    if trace:
+      trace.emit('transition', module=module, age_range=age_range, previous_state=previous_state, \
+                 prior=prior, applied=applied, posterior=transitions.posterior().tolist(), state=module_state)
 
   # return the status for that timeline and module and the update module_dict
-  return module_state, module_dict
\ No newline at end of file
+  return module_state, module_dict
+
+# a function comparing a whole column of values against a characteristic
+def char_matches_batch(char, column):
+  """
+  Vectorised version of char_matches
+  Parameters:
+    char: a CharRule
+    column: an array of patient values
+  Returns:
+    a boolean array of whether the characteristic applies to each value
+  """
+  if char.operator == '>':
+    return column.astype(np.int64) > char.threshold
+  if char.operator == '<':
+    return column.astype(np.int64) < char.threshold
+  # only strings can equal the value read from the input data
+  if column.dtype.kind in 'OUS':
+    return column == char.value
+  return np.zeros(len(column), dtype=bool)
+
+# a helper function for encoding values as indices into a vocabulary
+def encode(values, vocabulary):
+  """
+  Encode an array of values as their positions in a vocabulary
+  Parameters:
+    values: an array of values, all present in the vocabulary
+    vocabulary: a list of unique values
+  Returns:
+    an integer array of positions
+  """
+  vocabulary = np.asarray(vocabulary, dtype=object)
+  order = np.argsort(vocabulary)
+  return order[np.searchsorted(vocabulary[order], np.asarray(values, dtype=object))]
+
+# a helper function re-coding a categorical batch attribute into another vocabulary
+def recode(patients, attribute, vocabulary):
+  """
+  Positions of a categorical PatientBatch attribute in a vocabulary, found by
+  encoding the batch's own vocabulary once rather than every patient's value
+  Parameters:
+    patients: a PatientBatch
+    attribute: name of a categorical attribute, a key of patients.vocabularies
+    vocabulary: a list of unique values, including every value of the attribute
+  Returns:
+    an integer array of positions
+  """
+  return encode(patients.vocabularies[attribute], vocabulary)[getattr(patients, attribute)]
+
+# population level module runner
+def run_timelines_batch(patients, ages, modules, rng):
+  """
+  Advance a whole cohort through the age ranges one age range at a time.
+  Modules run in order within each age range, so dynamic characteristics see
+  the current age range's earlier modules and the previous age range's later
+  ones, as in run_module. As the multipliers scale every row of a transition
+  matrix alike, each patient's posterior transition matrix is kept as a single
+  vector of accumulated multipliers per module. Until a module's first initial
+  age range, patients have no state in it, coded as the number of its states.
+  Parameters:
+    patients: a PatientBatch, as returned by generate_patients_batch
+    ages: a list of age ranges
+    modules: a dictionary of CompiledModule by module name
+    rng: a numpy Generator
+  Returns:
+    bands: an integer array of each patient's current age range index
+    timelines: a dictionary of uint8 state indices (patients x age ranges) by module
+  """
+  bands = recode(patients, 'age_range', ages)
+  n = len(bands)
+  names = list(modules)
+  # no state yet, as the scalar generator's empty state before the first initial age range
+  timelines = {module: np.full((n, len(ages)), len(data.states), dtype=np.uint8) \
+               for module, data in modules.items()}
+
+  # multipliers from static characteristics, fixed for each patient
+  static_mult = {}
+  # multipliers accumulated from dynamic characteristics over the timeline
+  dynamic_mult = {}
+  for module, data in modules.items():
+    mult = np.ones((n, len(data.states)))
+    for char in data.static_char:
+      if char.variable in patients.vocabularies:
+        # match the values of the vocabulary, then look every patient's code up
+        matches = char_matches_batch(char, np.asarray(patients.vocabularies[char.variable], dtype=object))
+        mult[matches[getattr(patients, char.variable)]] *= char.mult
+      elif char.variable in patients:
+        mask = char_matches_batch(char, patients[char.variable])
+        mult[mask] *= char.mult
+    static_mult[module] = mult
+    dynamic_mult[module] = np.ones((n, len(data.states)))
+
+  # whether each dynamic characteristic applies to each state of the module it refers to, and to no state
+  state_masks = {}
+  for data in modules.values():
+    for char in data.dynamic_char:
+      if char.variable in modules:
+        state_masks[id(char)] = np.array([char_matches(char, state) \
+                                          for state in modules[char.variable].states + ['']])
+
+  for b, age_range in enumerate(ages):
+    # only patients who have reached this age range
+    active = np.nonzero(bands >= b)[0]
+    if len(active) == 0:
+      break
+
+    for k, (module, data) in enumerate(modules.items()):
+      if age_range in data.initial_prob:
+        ## initial set up, amended based on static characteristics
+        chosen = active
+        rows = data.initial_prob[age_range] * static_mult[module][chosen]
+      else:
+        ## transitions, amended based on dynamic characteristics
+        mult = dynamic_mult[module]
+        for char in data.dynamic_char:
+          if char.variable == 'age_range':
+            if char_matches(char, age_range):
+              mult[active] *= char.mult
+            continue
+          # modules run earlier in this age range, otherwise the previous age range
+          if char.variable in names[:k]:
+            column = timelines[char.variable][active, b]
+          elif char.variable in modules and b > 0:
+            column = timelines[char.variable][active, b - 1]
+          else:
+            continue
+          hit = active[state_masks[id(char)][column]]
+          mult[hit] *= char.mult
+        # there is no next state without a previous one, which the first age range never has
+        if b == 0:
+          continue
+        previous = timelines[module][active, b - 1]
+        known = previous < len(data.states)
+        chosen, previous = active[known], previous[known]
+        rows = data.trans_prob[previous] * static_mult[module][chosen] * mult[chosen]
+
+      # choose the next state for every patient at once
+      timelines[module][chosen, b] = draw_from_rows_batch(np.cumsum(rows, axis=1), rng.random(len(chosen)))
+
+  return bands, timelines
+
+# a helper function listing the timeline rows of a batch
+def timeline_rows(bands, ages, keep=None):
+  """
+  The patient and age range of every timeline row of a batch, in output order
+  Parameters:
+    bands: an integer array of each patient's current age range index
+    ages: a list of age ranges
+    keep: age ranges to keep rows for, a set of age ranges and `current`, all by default
+  Returns:
+    patient: an integer array of each row's patient
+    band: an integer array of each row's age range index
+  """
+  band = np.arange(len(ages))[None, :]
+  lived = band <= bands[:, None]
+  if keep is not None:
+    wanted = np.array([age_range in keep for age_range in ages])[None, :]
+    if 'current' in keep:
+      wanted = wanted | (band == bands[:, None])
+    lived = lived & wanted
+  return np.nonzero(lived)
+
+# a helper function for flattening batch timelines into rows
+def timelines_to_columns(ids, bands, ages, modules, timelines, keep=None):
+  """
+  Flatten batch timelines into columns, one row per patient per age range
+  Parameters:
+    ids: an array of patient ids
+    bands: an integer array of each patient's current age range index
+    ages: a list of age ranges
+    modules: a dictionary of CompiledModule by module name
+    timelines: a dictionary of state indices by module, from run_timelines_batch
+    keep: age ranges to keep rows for, a set of age ranges and `current`, all by default
+  Returns:
+    a dictionary of columns: id, age_range and one per module
+  """
+  patient, band = timeline_rows(bands, ages, keep)
+  columns = {
+    'id': np.asarray(ids)[patient],
+    'age_range': np.asarray(ages, dtype=object)[band],
+  }
+  for module, data in modules.items():
+    columns[module] = np.asarray(data.states + [''], dtype=object)[timelines[module][patient, band]]
+  return columns
@@ -0,0 +1,77 @@
+#!/usr/bin/python3
+import json
+import zlib
+
+class Tracer:
+  """
+  Collects structured probability trace events for a sample of patients.
+  Patients are sampled by a hash of their id, so the same patients are traced
+  whichever worker generates them and the random streams are left untouched.
+  Events are kept in memory and handed back with the chunk they belong to.
+
+  Attributes
+  ----------
+  rate: float, fraction of patients to trace
+  ids: set of patient ids to always trace
+  patient: id of the patient being traced, None when the current one is not
+  events: list of trace events, as dictionaries
+  """
+
+  def __init__(self, rate=0.0, ids=()):
+    self.rate = rate
+    self.ids = set(ids)
+    self.patient = None
+    self.events = []
+
+  def sampled(self, id):
+    """
+    Whether a patient is traced
+    Parameters:
+      id: patient id
+    Returns:
+      a boolean value
+    """
+    if id in self.ids:
+      return True
+    return zlib.crc32(id.encode()) < self.rate * 2 ** 32
+
+  def start_patient(self, patient):
+    """
+    Start tracing a patient if sampled
+    Parameters:
+      patient: a dictionary of patient information
+    Returns:
+      None
+    """
+    self.patient = patient['id'] if (self.rate or self.ids) and self.sampled(patient['id']) else None
+    if self.patient is not None:
+      self.emit('patient', **{key: value for key, value in patient.items() if key not in ('id', 'timelines')})
+
+  def emit(self, event, **fields):
+    """
+    Record an event for the patient being traced
+    Parameters:
+      event: event name
+      fields: values to record
+    Returns:
+      None
+    """
+    self.events.append({'patient': self.patient, 'event': event, **fields})
+
+  def __bool__(self):
+    return self.patient is not None
+
+# a tracer that traces no one, used when tracing is off
+NO_TRACER = Tracer()
+
+# a helper function to write trace events as JSON lines
+def write_trace(f, events):
+  """
+  Write trace events to an open file, one JSON object per line
+  Parameters:
+    f: an open file
+    events: a list of trace events
+  Returns:
+    None
+  """
+  f.writelines(json.dumps(event, default=str) + '\n' for event in events)
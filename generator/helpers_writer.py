@@ -0,0 +1,114 @@
+#!/usr/bin/python3
+import queue
+import threading
+from dataclasses import dataclass
+
+import numpy as np
+
+@dataclass
+class Columns:
+  """
+  Rows of a chunk held as one array per column, as the vectorised generators
+  produce them, for writers to serialise without building a tuple per row.
+  Categorical columns hold integer codes into a vocabulary, every other
+  column holds the values themselves.
+
+  Attributes
+  ----------
+  columns: dict of arrays by column name, in output order
+  vocabularies: dict of lists of values by coded column name
+  """
+
+  columns: dict
+  vocabularies: dict
+
+  def __len__(self):
+    return len(next(iter(self.columns.values()), ()))
+
+  def values(self, column):
+    """
+    A column's values, decoded from codes for categorical columns
+    """
+    values = self.columns[column]
+    if column in self.vocabularies:
+      return np.asarray(self.vocabularies[column], dtype=object)[values]
+    return values
+
+  def rows(self):
+    """
+    The rows as tuples, as the scalar generator writes them, dates as datetime.date
+    """
+    return list(zip(*(self.values(column).tolist() for column in self.columns)))
+
+class BackgroundWriter:
+  """
+  Runs write tasks in submission order on a dedicated thread, fed by a
+  bounded queue, so formatting, compressing and writing rows overlaps with
+  generation. Submitting blocks while the queue is full, which bounds the
+  number of chunks held in memory waiting to be written.
+  With a queue size of 0 every task runs in the calling thread instead.
+
+  Attributes
+  ----------
+  queue: a Queue of (function, arguments) tuples, None to stop
+  thread: the writer thread, None when writing in the calling thread
+  error: the first exception raised by a task, re-raised in the calling thread
+  """
+
+  def __init__(self, queue_size=4):
+    self.error = None
+    if queue_size > 0:
+      self.queue = queue.Queue(maxsize=queue_size)
+      self.thread = threading.Thread(target=self.run, name='writer', daemon=True)
+      self.thread.start()
+    else:
+      self.queue = None
+      self.thread = None
+
+  def run(self):
+    """
+    Run tasks until told to stop, skipping the rest after a failure
+    """
+    while True:
+      task = self.queue.get()
+      if task is None:
+        return
+      if self.error is None:
+        fn, args = task
+        try:
+          fn(*args)
+        except BaseException as e:
+          self.error = e
+
+  def submit(self, fn, *args):
+    """
+    Queue a task, raising any failure of an earlier one
+    Parameters:
+      fn: a callable
+      args: arguments to call it with
+    Returns:
+      None
+    """
+    if self.error is not None:
+      raise self.error
+    if self.thread is None:
+      fn(*args)
+    else:
+      self.queue.put((fn, args))
+
+  def close(self):
+    """
+    Wait for every queued task to finish, raising any failure
+    """
+    if self.thread is not None:
+      self.queue.put(None)
+      self.thread.join()
+      self.thread = None
+    if self.error is not None:
+      raise self.error
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exc):
+    self.close()
@@ -1,11 +1,16 @@
 #!/usr/bin/python3
-from dataclasses import dataclass, field
+from dataclasses import dataclass, field, fields
+from datetime import date
 
-@dataclass
+import numpy as np
+
+@dataclass(slots=True)
 class Patient:
     """
     A class to represent a patient.
-    
+    Attributes are stored in slots rather than a per-instance dictionary,
+    and can also be read by name, as in patient['age_range'].
+
     Attributes
     ----------
     id: str
@@ -14,20 +19,90 @@ class Patient:
     ethnicity: str
     gender: str
     age_range: str
-    dob: str
+    dob: date
     age: int
     deprivation_level: int
-    timelines: dict (empty by default)
     """
-    
+
     id: str
     region: str
     area: str
     ethnicity: str
     gender: str
     age_range: str
-    dob: str
+    dob: date
     age: int
     deprivation_level: int
-    timelines: dict = field(default_factory=dict)
-        
+
+    def __getitem__(self, key):
+        return getattr(self, key)
+
+    def __contains__(self, key):
+        return key in self.__slots__
+
+    def keys(self):
+        return [f.name for f in fields(self)]
+
+    def items(self):
+        return [(key, getattr(self, key)) for key in self.keys()]
+
+
+@dataclass
+class PatientBatch:
+    """
+    A class to represent a batch of patients as one array per attribute.
+    Categorical attributes are stored as small integer codes into vocabularies
+    shared by the whole run, and are decoded to values when read by name,
+    as in patients['region'].
+
+    Attributes
+    ----------
+    vocabularies: dict of lists of values by categorical attribute
+    id: array of ids, None for batches generated without ids
+    region: int16 array of codes
+    area: int16 array of codes
+    ethnicity: int16 array of codes
+    gender: uint8 array of codes
+    age_range: uint8 array of codes
+    dob: datetime64[D] array
+    age: uint8 array
+    deprivation_level: int32 array
+    states: dict of uint8 arrays of states by module (patients x age ranges), empty until timelines are generated
+    """
+
+    vocabularies: dict
+    id: np.ndarray
+    region: np.ndarray
+    area: np.ndarray
+    ethnicity: np.ndarray
+    gender: np.ndarray
+    age_range: np.ndarray
+    dob: np.ndarray
+    age: np.ndarray
+    deprivation_level: np.ndarray
+    states: dict = field(default_factory=dict)
+
+    COLUMNS = ('id', 'region', 'area', 'ethnicity', 'gender', 'age_range', 'dob', 'age', 'deprivation_level')
+
+    def __getitem__(self, key):
+        if key not in self.COLUMNS:
+            raise KeyError(key)
+        values = getattr(self, key)
+        if key in self.vocabularies:
+            return np.array(self.vocabularies[key], dtype=object)[values]
+        return values
+
+    def __contains__(self, key):
+        return key in self.COLUMNS
+
+    def __len__(self):
+        return len(self.age_range)
+
+    def keys(self):
+        return list(self.COLUMNS)
+
+    def values(self):
+        return [self[key] for key in self.COLUMNS]
+
+    def items(self):
+        return [(key, self[key]) for key in self.COLUMNS]
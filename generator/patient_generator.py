@@ -1,30 +1,53 @@
 #!/usr/bin/python3
 
+import os
+import random
+import numpy as np
+from datetime import date
 from pandas import read_csv
 
 from configparser import ConfigParser
 
 # import helper functions
-from .helpers_id import generate_nhi_id, generate_random_id
-from .helpers_patient import select_region, select_area, select_ethnicity, \
-    select_gender, select_age, calculate_age, match_deprivation 
-from .helpers_csv import create_csv
-from .helpers_timelines import  set_initial_prob, run_module
+from .helpers_id import generate_nhi_id, generate_random_id, generate_ids
+from .helpers_patient import build_demographic_index, sample_demographics, \
+    select_dob, calculate_age, sample_demographics_batch, generate_DOB_batch, \
+    calculate_age_batch, build_deprivation_index, lookup_deprivation
+from .helpers_csv import COMPRESSIONS, create_csv, CSVWriter
+from .helpers_arrow import import_pyarrow, build_schema, ArrowWriter
+from .helpers_sqlite import SQLiteDatabase
+from .helpers_profile import Profiler, NO_PROFILER
+from .helpers_trace import Tracer, NO_TRACER
+from .helpers_writer import Columns
+from .helpers_aggregate import strata_vocabularies, count_states
+from .helpers_bundle import input_digest, bundle_location, save_bundle, load_bundle, \
+    validate_demographics, validate_deprivation, validate_module
+from .helpers_timelines import  compile_module, set_initial_prob, run_module, \
+    run_timelines_batch, timeline_rows, timelines_to_columns, PosteriorCache
 # import patient class
-from .patient_class import Patient
+from .patient_class import Patient, PatientBatch
 
+# possible age ranges
+AGES = ['0_4',	'5_9',	'10_14', '15_19',	'20_24',	'25_29', '30_34',	'35_39', \
+        '40_44',	'45_49',	'50_54',	'55_59',	'60_64',	'65_69',	'70_74', \
+        '75_79',	'80_84',	'85_']
 
-def generator_set_up():
+# columns of the patients output
+PATIENT_COLUMNS = ['id', 'region', 'area', 'ethnicity', 'gender', 'age_range', 'dob', 'deprivation_level']
+
+# available generators: patient by patient, or vectorised over each chunk
+ENGINES = ('scalar', 'batch')
+
+
+def reference_inputs():
     """
-    A function that sets up empty CSV files and loads in available modules
+    A function that reads the locations of the reference data from the config
     Parameters:
         None
     Returns:
         country: specified country to generate patients for
-        demographics: a DataFrame containing demographic information for that location
-        deprivation: a DataFrame containing deprivation scores for selected location
-        ages: a list of age ranges
-        modules: a dictionary containing module information
+        inputs: a dictionary of demographics and deprivation file paths
+        module_inputs: a dictionary of module file paths by module name
     """
     # read the configuration file
     parser = ConfigParser()
@@ -34,67 +57,245 @@ def generator_set_up():
     country = parser.get('generate', 'country')
 
     # get the demographic data and deprivation data
-    demographics_loc = parser.get(country, 'demographics')
-    deprivation_loc = parser.get(country, 'deprivation')
+    inputs = {'demographics': parser.get(country, 'demographics'), \
+              'deprivation': parser.get(country, 'deprivation')}
+    module_inputs = dict(parser.items(''.join([country, '_modules'])))
+    return country, inputs, module_inputs
+
+
+def reference_digest():
+    """
+    A function that hashes the contents of the reference data
+    Parameters:
+        None
+    Returns:
+        a hex digest
+    """
+    country, inputs, module_inputs = reference_inputs()
+    return input_digest(country, {**inputs, **module_inputs})
+
+
+def find_bundle():
+    """
+    A function that looks for a bundle compiled from the current reference data
+    Parameters:
+        None
+    Returns:
+        the bundle's location, None if the reference data has not been compiled
+    """
+    location = bundle_location(reference_digest())
+    return location if os.path.isdir(location) else None
+
+
+def compile_bundle():
+    """
+    A function that validates the reference data and compiles it into a bundle,
+    to be loaded by later runs instead of the input files
+    Parameters:
+        None
+    Returns:
+        location: directory the bundle was saved to
+        digest: hex digest of the inputs the bundle was compiled from
+    """
+    country, inputs, module_inputs = reference_inputs()
+    digest = input_digest(country, {**inputs, **module_inputs})
+
+    demographics = read_csv(inputs['demographics'])
+    deprivation = read_csv(inputs['deprivation'])
+    module_data = {module: read_csv(data) for module, data in module_inputs.items()}
+
+    # report every problem at once, rather than the first one found
+    problems = validate_demographics(demographics, AGES) + validate_deprivation(deprivation)
+    for module, data in module_data.items():
+        problems += validate_module(module, data)
+    if problems:
+        raise ValueError('\n'.join(problems))
+
+    modules = {module: compile_module(module, data) for module, data in module_data.items()}
+    demographic_index = build_demographic_index(demographics)
+    deprivation = build_deprivation_index(deprivation, demographic_index.areas)
+
+    location = bundle_location(digest)
+    save_bundle(location, digest, country, demographic_index, deprivation, modules)
+    return location, digest
+
+
+def generator_set_up(reference_date=None, bundle=None):
+    """
+    A function that loads in available modules and reference data
+    Parameters:
+        reference_date: the date ages are calculated at, the current date by default
+        bundle: location of a compiled bundle to load instead of the input files, as returned by find_bundle
+    Returns:
+        country: specified country to generate patients for
+        demographic_index: a DemographicIndex compiled from demographic information for that location
+        deprivation: a DeprivationIndex compiled from deprivation scores for selected location
+        ages: a list of age ranges
+        modules: a dictionary of CompiledModule by module name
+    """
+    if bundle is not None:
+        print(f"Loading compiled reference data from {bundle}")
+        country, demographic_index, deprivation, modules = \
+            load_bundle(bundle, reference_date if reference_date else date.today())
+    else:
+        country, inputs, module_inputs = reference_inputs()
+        modules = {module: compile_module(module, read_csv(data)) for module, data in module_inputs.items()}
+
+        # import demographics and deprivation
+        demographics = read_csv(inputs['demographics'])
+        deprivation = read_csv(inputs['deprivation'])
 
-    # iterate over modules for that location and create a dictionary
-    modules = {}
+        # compile the demographics once, so that patients can be drawn without pandas
+        demographic_index = build_demographic_index(demographics, reference_date)
+        # and the deprivation scores
+        deprivation = build_deprivation_index(deprivation, demographic_index.areas)
+
+    # list the modules for that location
     print(f"===================================================================================================")
     print(f"Loading available modules:")
-    for module, data in parser.items(''.join([country, '_modules'])):
-        modules[module] =  read_csv(data)
+    for module in modules:
         print(f"{module}")
     print(f"===================================================================================================")
     print()
 
-    # import demographics and deprivation
-    demographics = read_csv(demographics_loc)
-    deprivation = read_csv(deprivation_loc)
+    # report areas that have no deprivation score
+    if deprivation.unmatched:
+        print(f"{len(deprivation.unmatched)} areas have no deprivation score and use the average of {deprivation.fallback}:")
+        print(', '.join(deprivation.unmatched))
+        print()
 
-    # set a list of possible age ranges
-    ages = ['0_4',	'5_9',	'10_14', '15_19',	'20_24',	'25_29', '30_34',	'35_39', \
-            '40_44',	'45_49',	'50_54',	'55_59',	'60_64',	'65_69',	'70_74', \
-            '75_79',	'80_84',	'85_']
+    return country, demographic_index, deprivation, list(AGES), modules
 
-    # set up output files for patients and timelines
-    header_patient = "id,region,area,ethnicity,gender,age_range,dob,deprivation_level"
-    create_csv('output/patients.csv', header_patient)
-    header_timeline = "id,age_range"
-    for module in modules:
-        header_timeline += ',' + module
-    create_csv('output/timelines.csv', header_timeline)
 
-    return country, demographics, deprivation, ages, modules
+def output_files(output_format, output_dir='output', compression='none'):
+    """
+    A function that names the output files for patients and timelines
+    Parameters:
+        output_format: one of `csv`, `parquet` or `arrow`
+        output_dir: directory the files are written to
+        compression: one of `none`, `gzip` or `zstd`, which adds an extension to csv files
+    Returns:
+        a dictionary of file locations, by `patients` and `timelines`
+    """
+    extension = output_format + (COMPRESSIONS[compression] if output_format == 'csv' else '')
+    return {name: os.path.join(output_dir, f'{name}.{extension}') for name in ('patients', 'timelines')}
+
+
+def create_writers(output_format, demographic_index, ages, modules, buffer_size=10000, output_dir='output', \
+                   append=False, compression='none', database=None):
+    """
+    A function that sets up empty output files for patients and timelines
+    Parameters:
+        output_format: one of `csv`, `parquet` or `arrow`
+        demographic_index: a DemographicIndex compiled from demographic information
+        ages: a list of age ranges
+        modules: a dictionary of CompiledModule by module name
+        buffer_size: number of rows to collect before writing them out
+        output_dir: directory to write the files to
+        append: boolean, whether to append to csv files left by an earlier run rather than start new ones
+        compression: one of `none`, `gzip` or `zstd`
+        database: location of a SQLite database to write to instead of files
+    Returns:
+        patients: a writer for the patients output
+        timelines: a writer for the timelines output
+    """
+    timeline_columns = ['id', 'age_range'] + list(modules)
+
+    if database is not None:
+        # analysts look patients up by id and region, and timelines by id and module state
+        os.makedirs(os.path.dirname(database) or '.', exist_ok=True)
+        db = SQLiteDatabase(database, {
+            'patients': [(column, 'INTEGER' if column == 'deprivation_level' else 'TEXT') \
+                         for column in PATIENT_COLUMNS],
+            'timelines': [(column, 'TEXT') for column in timeline_columns],
+        }, [('patients', 'id', True), ('patients', 'region', False), ('timelines', 'id', False)] + \
+           [('timelines', module, False) for module in modules])
+        return db.writer('patients', PATIENT_COLUMNS, buffer_size), \
+            db.writer('timelines', timeline_columns, buffer_size)
+
+    os.makedirs(output_dir, exist_ok=True)
+    files = output_files(output_format, output_dir, compression)
+    patients_file, timelines_file = files['patients'], files['timelines']
+
+    if output_format == 'csv':
+        if not append:
+            create_csv(patients_file, ','.join(PATIENT_COLUMNS), compression)
+            create_csv(timelines_file, ','.join(timeline_columns), compression)
+        return CSVWriter(patients_file, buffer_size, compression), \
+            CSVWriter(timelines_file, buffer_size, compression)
+
+    # every possible value of the categorical columns, derived from the loaded data
+    pa = import_pyarrow()
+    age_ranges = list(dict.fromkeys(ages + demographic_index.age_ranges))
+    patient_vocabularies = {
+        'region': demographic_index.regions,
+        'area': list(dict.fromkeys(demographic_index.areas)),
+        'ethnicity': list(dict.fromkeys(demographic_index.ethnicities)),
+        'gender': demographic_index.genders,
+        'age_range': age_ranges,
+    }
+    timeline_vocabularies = {'age_range': age_ranges}
+    timeline_vocabularies.update({module: data.states for module, data in modules.items()})
+
+    patient_schema = build_schema(PATIENT_COLUMNS, patient_vocabularies, \
+                                  {'dob': pa.date32(), 'deprivation_level': pa.int64()})
+    timeline_schema = build_schema(timeline_columns, timeline_vocabularies, \
+                                   metadata={'modules': ','.join(modules)})
+    return ArrowWriter(patients_file, patient_schema, \
+                       patient_vocabularies, output_format, buffer_size, compression), \
+        ArrowWriter(timelines_file, timeline_schema, \
+                    timeline_vocabularies, output_format, buffer_size, compression)
     
 
-def generate_patient(country, demographics, deprivation, ages, modules, display=False, prob=False):
+def module_stages(modules):
+    """
+    Names of the profiler stages of each module, built once rather than for every age range of every patient
+    Parameters:
+        modules: a dictionary of CompiledModule by module name
+    Returns:
+        a dictionary of (set_initial_prob stage, run_module stage) by module name
+    """
+    return {module: (f'set_initial_prob: {module}', f'run_module: {module}') for module in modules}
+
+
+def generate_patient(country, demographic_index, deprivation, ages, modules, display=False, trace=NO_TRACER, rng=random, \
+                     patient_id=None, profiler=NO_PROFILER, bands=None, cache=None, stages=None):
     """
     Patient and timeline generator
     Parameters:
-        demographics: a DataFrame containing demographic information
-        deprivation: a DataFrame contaning deprivation scores
+        demographic_index: a DemographicIndex compiled from demographic information
+        deprivation: a DeprivationIndex compiled from deprivation scores
         ages: a list of age ranges
-        modules: a dictionary of module and probabilities
+        modules: a dictionary of CompiledModule by module name
         display: a boolean value, whether to display patient information while generating
-        prob: boolean, whether to show probability information
+        trace: a Tracer recording probability details, off by default
+        rng: source of random numbers, the random module by default
+        patient_id: id to give the patient, a randomly generated one by default
+        profiler: a Profiler recording time spent by stage, disabled by default
+        bands: age ranges to return timeline records for, as parsed by parse_bands, all by default
+        cache: a PosteriorCache of static characteristic results shared between patients, off by default
+        stages: profiler stage names by module, as returned by module_stages, built for the patient by default
     Returns:
         None
     """
+    if stages is None:
+        stages = module_stages(modules)
 
     ## Patient generation
     # generate information for a patient
-    # if country is NZ, generate NHI number
-    if country == 'NZ':
-        id = generate_nhi_id()
+    tic = profiler.start()
+    # if no id is given and country is NZ, generate NHI number
+    if patient_id is not None:
+        id = patient_id
+    elif country == 'NZ':
+        id = generate_nhi_id(rng)
     else:
-        id = generate_random_id()
-    region = select_region(demographics)
-    area = select_area(demographics, region)
-    ethnicity = select_ethnicity(demographics, region, area)
-    gender = select_gender(demographics, region, area, ethnicity)
-    dob, age_range = select_age(demographics, region, area, ethnicity)
-    deprivation_level = match_deprivation(deprivation, area)
-    age = calculate_age(dob)
+        id = generate_random_id(rng)
+    region, area, ethnicity, gender, age_range = sample_demographics(demographic_index, rng)
+    dob = select_dob(demographic_index, age_range, rng)
+    deprivation_level = lookup_deprivation(deprivation, area)
+    age = calculate_age(dob, demographic_index.reference_date)
+    profiler.stop('demographics', tic)
 
     # generate a patient object
     patient = Patient(id, region, area, ethnicity, gender, age_range, dob, age, deprivation_level)
@@ -108,26 +309,20 @@ def generate_patient(country, demographics, deprivation, ages, modules, display=
     result.append(patient_data)
     #append_to_csv('output/patients.csv', patient_data)
 
-    if prob:
-        print()
-        print(f"===========================================================================================================================================")
-        print(f"Current patient: {patient.id}, region: {patient.region}, area: {patient.area}, age: {patient.age}, ethnicity: {patient.ethnicity}, gender: {patient.gender}, deprivation: {patient.deprivation_level}")
-        print(f"===========================================================================================================================================")
+    trace.start_patient(patient)
 
     ## Set up prior initial probabilities for all modules
     # create a dictionary of modules
-    # to store prior state transition probabilities
+    # to store posterior state transitions and current states
     module_dict = {}
     for module, data in modules.items():
-        states, prior_trans_prob = set_initial_prob(module, data, patient.__dict__, prob)
-        # add the states, prior state transition probabilities and prior state multiplications to the module dictionary
-        module_dict[module] = (states, prior_trans_prob,'')
+        tic = profiler.start()
+        module_dict[module] = set_initial_prob(module, data, patient, trace, cache)
+        profiler.stop(stages[module][0], tic)
 
     ## Timeline generation
     # get the index of the current age range from the list plus 1
     index = ages.index(patient.age_range) + 1
-    # set up an emtpy dictionary for timeline records
-    timelines_dict = {}
     # set up previous timeline as an empty dictionary, to be used for the first record
     previous_timeline = {}
 
@@ -135,42 +330,326 @@ def generate_patient(country, demographics, deprivation, ages, modules, display=
     # iterate through ages until max age range
     for age in zip(range(index), ages):
 
-        if prob:
-            print()
-            print(f"=====================")
-            print(f"Age range: {age[1]}")
-
         # create an empty dictionary to use as module results
         current_timeline = {'age_range': age[1]}
 
         # iterate through each module and run it
         for module, data in modules.items():
             # run the module and extract result
-            new_state, new_module_dict = run_module(module, data, age[1], patient.__dict__, current_timeline, previous_timeline, module_dict, prob)
+            tic = profiler.start()
+            new_state, new_module_dict = run_module(module, data, age[1], patient, current_timeline, previous_timeline, module_dict, trace, rng, cache)
+            profiler.stop(stages[module][1], tic)
             # result should be a selected status for that age range and module
             current_timeline[module] = new_state
             # update the module_dict
             module_dict = new_module_dict
 
-        # amend previous timeline to a copy of the current timeline
+        # amend previous timeline to the current timeline
         # it will be used by the next timeline iteration
-        previous_timeline = current_timeline.copy()
-
-        # after all modules run, add it to the timelines dictionary
-        timelines_dict[age[1]] = current_timeline
-
-        # save to timelines' file
-        data = [patient.id] + list(current_timeline.values())
-        result.append(data)
-        #append_to_csv('output/timelines.csv', data)
-    # add the timelines to the patient object
-    patient.timelines = timelines_dict
+        previous_timeline = current_timeline
 
-    if prob:
-        print(f"===================================================================================================")
-        print(f"Next patient")
+        # save to timelines' file, if the age range is wanted
+        if keep_band(bands, age[1], age[0] == index - 1):
+            data = [patient.id] + list(current_timeline.values())
+            result.append(data)
 
     if display:
         print(f"Patient: {patient.id}, {patient.region}, {patient.area}, {patient.ethnicity}, {patient.gender}, {patient.age_range}, {patient.dob}, {patient.deprivation_level}")
 
-    return result
\ No newline at end of file
+    return result
+
+
+def chunk_counts(population, chunk_size):
+    """
+    Split a population into chunks of at most chunk_size patients
+    Parameters:
+        population: number of patients to produce
+        chunk_size: maximum number of patients in a chunk
+    Returns:
+        a generator of chunk sizes
+    """
+    for start in range(0, population, chunk_size):
+        yield min(chunk_size, population - start)
+
+
+def parse_bands(value, ages):
+    """
+    Parse which age ranges to output timeline records for
+    Parameters:
+        value: `all`, `current` or a comma separated list of age ranges and `current`
+        ages: a list of age ranges
+    Returns:
+        bands: None for all age ranges, otherwise a set of age ranges and `current`
+    """
+    if value == 'all':
+        return None
+    bands = set(value.split(','))
+    unknown = bands - set(ages) - {'current'}
+    if unknown:
+        raise ValueError(f"Unknown age ranges {', '.join(sorted(unknown))}, expected all, current or {', '.join(ages)}")
+    return bands
+
+
+def keep_band(bands, age_range, current):
+    """
+    Whether to output the timeline record of an age range
+    Parameters:
+        bands: age ranges to output, as returned by parse_bands
+        age_range: the age range of the record
+        current: boolean, whether it is the patient's current age range
+    Returns:
+        a boolean value
+    """
+    return bands is None or age_range in bands or (current and 'current' in bands)
+
+
+# reference data shared by every task run in a worker process
+_worker_data = {}
+# options of the run, not passed on to generate_patient
+_worker_options = {}
+
+
+def init_worker(country, demographic_index, deprivation, ages, modules, display=False, trace_sample=0.0, \
+                trace_ids=(), profile=False, bands=None, cache_size=0):
+    """
+    Pool initializer storing the reference data once per worker process,
+    so that tasks only need to carry a patient count and a seed
+    Parameters:
+        country: specified country to generate patients for
+        demographic_index: a DemographicIndex compiled from demographic information
+        deprivation: a DeprivationIndex compiled from deprivation scores
+        ages: a list of age ranges
+        modules: a dictionary of CompiledModule by module name
+        display: a boolean value, whether to display patient information while generating
+        trace_sample: fraction of patients to record probability details for
+        trace_ids: ids of patients to always record probability details for
+        profile: boolean, whether to record time spent by stage
+        bands: age ranges to output timeline records for, as returned by parse_bands
+        cache_size: number of static profiles to keep in each worker's PosteriorCache, 0 to disable it
+    Returns:
+        None
+    """
+    # the cache stays warm across every chunk the worker generates, and every
+    # thread of the thread backend, which runs this once per thread, keeps the first thread's
+    cache = _worker_data.get('cache')
+    if _worker_data.get('modules') is not modules or cache is None or cache.maxsize != cache_size:
+        cache = PosteriorCache(cache_size) if cache_size > 0 else None
+    _worker_data.update(country=country, demographic_index=demographic_index, \
+                        deprivation=deprivation, ages=ages, modules=modules, \
+                        display=display, bands=bands, cache=cache, stages=module_stages(modules))
+    _worker_options.update(trace_sample=trace_sample, trace_ids=trace_ids, profile=profile)
+
+
+def init_bundle_worker(bundle, reference_date, *options):
+    """
+    Pool initializer memory-mapping a compiled bundle, so that worker processes
+    share its arrays rather than each receiving a copy of the reference data
+    Parameters:
+        bundle: location of a compiled bundle, as returned by find_bundle
+        reference_date: the date ages are calculated at
+        options: the remaining arguments of init_worker, from display on
+    Returns:
+        None
+    """
+    country, demographic_index, deprivation, modules = load_bundle(bundle, reference_date)
+    init_worker(country, demographic_index, deprivation, list(AGES), modules, *options)
+
+
+def worker_set_up(backend, reference, bundle=None, reference_date=None, options=()):
+    """
+    A function that selects how workers receive the reference data
+    Parameters:
+        backend: one of `serial`, `process` or `thread`
+        reference: a tuple of country, demographic index, deprivation index, ages and modules
+        bundle: location of the compiled bundle the reference data was loaded from, if any
+        reference_date: the date ages are calculated at
+        options: the remaining arguments of init_worker, from display on
+    Returns:
+        initializer: init_worker or init_bundle_worker
+        initargs: arguments for the initializer
+    """
+    # threads and the serial backend already share the loaded reference data
+    if bundle is not None and backend == 'process':
+        return init_bundle_worker, (bundle, reference_date) + tuple(options)
+    return init_worker, tuple(reference) + tuple(options)
+
+
+def chunk_seed_sequence(entropy, index):
+    """
+    Seed sequence for a single chunk of a run, independent of every other chunk
+    Equal to the index-th child spawned from SeedSequence(entropy), so any chunk
+    can be regenerated without replaying earlier ones
+    Parameters:
+        entropy: the run's seed
+        index: the chunk's position in the run
+    Returns:
+        a numpy SeedSequence
+    """
+    return np.random.SeedSequence(entropy, spawn_key=(index,))
+
+
+def generate_chunk(count, entropy, index, start):
+    """
+    Generate a chunk of patients from the reference data set up by init_worker
+    Parameters:
+        count: number of patients to generate
+        entropy: the run's seed
+        index: the chunk's position in the run
+        start: position of the chunk's first patient in the run
+    Returns:
+        patients: a list of patient rows
+        timelines: a list of timeline rows
+        stages: time spent by stage, empty unless profiling
+        events: probability trace events of the sampled patients
+    """
+    profiler = Profiler(enabled=_worker_options['profile'])
+    tracer = Tracer(_worker_options['trace_sample'], _worker_options['trace_ids'])
+    sequence = chunk_seed_sequence(entropy, index)
+    rng = random.Random(int(sequence.generate_state(1, np.uint64)[0]))
+    patients = []
+    timelines = []
+    # the whole chunk uses the same cache, even if another thread sets up the worker data meanwhile
+    data = dict(_worker_data)
+    # ids are distinct across the whole run, whichever chunk they come from
+    ids = generate_ids(data['country'], start, count, entropy)
+    cache = data['cache']
+    # a chunk runs in a single thread, so the thread's counts are the chunk's
+    if cache is not None:
+        cache.take_counts()
+    for patient_id in ids:
+        result = generate_patient(**data, trace=tracer, rng=rng, patient_id=patient_id, profiler=profiler)
+        patients.append(result[0])
+        timelines.extend(result[1:])
+    # report this chunk's cache lookups
+    if cache is not None:
+        for lookup, (hits, misses) in cache.take_counts().items():
+            profiler.count(f'cache hit: {lookup}', hits)
+            profiler.count(f'cache miss: {lookup}', misses)
+    return patients, timelines, profiler.stages, tracer.events
+
+
+def generate_batch_chunk(count, entropy, index, start):
+    """
+    Generate a chunk of patients with the vectorised generators, from the
+    reference data set up by init_worker, as columns for the writers' write_columns
+    Parameters:
+        count: number of patients to generate
+        entropy: the run's seed
+        index: the chunk's position in the run
+        start: position of the chunk's first patient in the run
+    Returns:
+        patients: a Columns chunk of patients, categorical columns as codes
+        timelines: a Columns chunk of timeline rows, age ranges and states as codes
+        stages: time spent by stage, empty unless profiling
+        events: always empty, as the vectorised generators are not traced
+    """
+    profiler = Profiler(enabled=_worker_options['profile'])
+    rng = np.random.default_rng(chunk_seed_sequence(entropy, index))
+    data = _worker_data
+    tic = profiler.start()
+    batch = generate_patients_batch(count, data['country'], data['demographic_index'], \
+                                    data['deprivation'], rng, start, entropy)
+    profiler.stop('demographics', tic)
+    tic = profiler.start()
+    ages, modules = data['ages'], data['modules']
+    current, states = run_timelines_batch(batch, ages, modules, rng)
+    profiler.stop('timelines', tic)
+
+    # the batch's codes are written as they are, with the vocabularies they index
+    patients = Columns({column: getattr(batch, column) for column in PATIENT_COLUMNS}, \
+                       {column: values for column, values in batch.vocabularies.items() if column in PATIENT_COLUMNS})
+    patient, band = timeline_rows(current, ages, data['bands'])
+    columns = {'id': batch.id[patient], 'age_range': band}
+    columns.update({module: states[module][patient, band] for module in modules})
+    # patients without a state yet have the code after the module's last state, written as ''
+    vocabularies = {'age_range': ages}
+    vocabularies.update({module: module_data.states + [''] for module, module_data in modules.items()})
+    timelines = Columns(columns, vocabularies)
+    if data['display']:
+        for row in patients.rows():
+            print(f"Patient: {', '.join(map(str, row))}")
+    return patients, timelines, profiler.stages, []
+
+
+def aggregate_chunk(count, entropy, index, start):
+    """
+    Generate a chunk of patients with the vectorised generators and count their
+    module states by stratum and age range, without keeping any patient rows
+    Parameters:
+        count: number of patients to generate
+        entropy: the run's seed
+        index: the chunk's position in the run
+        start: position of the chunk's first patient in the run
+    Returns:
+        counts: a dictionary of count arrays by module, as returned by count_states
+    """
+    rng = np.random.default_rng(chunk_seed_sequence(entropy, index))
+    data = _worker_data
+    # counts never use ids, so populations beyond the id space can be aggregated
+    patients = generate_patients_batch(count, data['country'], data['demographic_index'], \
+                                       data['deprivation'], rng, start, entropy, ids=False)
+    bands, timelines = run_timelines_batch(patients, data['ages'], data['modules'], rng)
+    vocabularies = strata_vocabularies(data['demographic_index'], data['deprivation'])
+    return count_states(patients, bands, timelines, data['ages'], data['modules'], vocabularies)
+
+
+def generate_patients_batch(n, country, demographic_index, deprivation, rng=None, start=0, entropy=None, ids=True):
+    """
+    Vectorised patient generator, drawing demographics for n patients at once
+    Parameters:
+        n: number of patients to generate
+        country: specified country to generate patients for
+        demographic_index: a DemographicIndex compiled from demographic information
+        deprivation: a DeprivationIndex compiled from deprivation scores
+        rng: a numpy Generator, a freshly seeded one by default
+        start: position of the first patient in the run
+        entropy: the run's seed, drawn from rng by default
+        ids: boolean, whether to generate ids, which limits start + n to the size of the id space
+    Returns:
+        patients: a PatientBatch, without ids if ids is False
+    """
+    if rng is None:
+        rng = np.random.default_rng()
+
+    # ids are distinct for batches of the same run with disjoint positions
+    if entropy is None:
+        entropy = int(rng.integers(2**63))
+    ids = np.array(generate_ids(country, start, n, entropy), dtype=object) if ids else None
+
+    regions, areas, rows, genders, age_ranges = sample_demographics_batch(demographic_index, n, rng)
+    dob = generate_DOB_batch(demographic_index, age_ranges, rng)
+
+    # categorical attributes are kept as codes into the run's vocabularies
+    return PatientBatch(
+        vocabularies=demographic_index.vocabularies,
+        id=ids,
+        region=regions.astype(np.int16),
+        area=areas.astype(np.int16),
+        ethnicity=demographic_index.row_ethnicity[rows].astype(np.int16),
+        gender=genders.astype(np.uint8),
+        age_range=age_ranges.astype(np.uint8),
+        dob=dob,
+        age=calculate_age_batch(dob, demographic_index.reference_date).astype(np.uint8),
+        deprivation_level=deprivation.by_area[areas].astype(np.int32),
+    )
+
+
+def generate_timelines_batch(patients, ages, modules, rng=None, bands=None):
+    """
+    Vectorised timeline generator, advancing a batch of patients together
+    Parameters:
+        patients: a PatientBatch, as returned by generate_patients_batch
+        ages: a list of age ranges
+        modules: a dictionary of CompiledModule by module name
+        rng: a numpy Generator, a freshly seeded one by default
+        bands: age ranges to return rows for, as returned by parse_bands, all by default
+    Returns:
+        timelines: a dictionary of columns, one row per patient per age range
+    """
+    if rng is None:
+        rng = np.random.default_rng()
+
+    current, timelines = run_timelines_batch(patients, ages, modules, rng)
+    # keep the state codes with the batch, one uint8 per module per age range
+    patients.states.update(timelines)
+    return timelines_to_columns(patients['id'], current, ages, modules, timelines, bands)
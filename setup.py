@@ -6,12 +6,17 @@ setup(
     author='Maciej Tarsa',
     author_email='maciej.tarsa@gmail.com',
     py_modules=["generator"],
+    python_requires=">=3.10",
     install_requires=[
         "Click",
         "Pandas",
+        "NumPy",
         "TQDM",
-        "progress",
     ],
+    extras_require={
+        "arrow": ["pyarrow"],
+        "zstd": ["zstandard"],
+    },
     entry_points='''
         [console_scripts] 
             generate_patients=generator.__main__:main